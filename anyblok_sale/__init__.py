@@ -6,3 +6,10 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 # -*- coding: utf-8 -*-
+
+
+def anyblok_init_config(unittest=False):
+    """Declare the sale configuration options, called by AnyBlok before
+    the configuration is parsed
+    """
+    from . import config  # noqa
@@ -0,0 +1,294 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+"""Benchmarks of the sale bloks
+
+Each benchmark is a function taking the registry, preparing its data and
+returning the callable to time, or None when its data is not available.
+Every benchmark runs in a savepoint rolled back at the end, nothing is kept
+in the database.
+
+The results are dumped as JSON so they can be compared between commits::
+
+    anyblok_sale_benchmark -c bench.cfg --benchmark-output before.json
+"""
+import json
+import platform
+import subprocess
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal as D
+from statistics import mean, median
+from time import perf_counter
+
+from anyblok.config import Configuration
+from sqlalchemy import func, text
+
+from anyblok_sale.bloks.sale_base.base import compute_price, compute_discount
+from anyblok_sale.dataset import DatasetGenerator
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, number=1, repeat=5):
+    """Register a benchmark
+
+    :param name: name of the benchmark in the results
+    :param number: calls of the timed callable per measure
+    :param repeat: number of measures
+    """
+    def wrapper(prepare):
+        BENCHMARKS[name] = (prepare, number, repeat)
+        return prepare
+
+    return wrapper
+
+
+def create_items(registry, count, prefix='BENCH'):
+    Item = registry.Product.Item
+    return [Item.insert(code="%s-%06d" % (prefix, i), name="Item %d" % i)
+            for i in range(count)]
+
+
+def create_price_list(registry, items, code='BENCH'):
+    price_list = registry.Sale.PriceList.create(code=code, name=code)
+    for item in items:
+        registry.Sale.PriceList.Item.create(
+            price_list=price_list, item=item, unit_price=D('12.34'),
+            unit_tax=D('0.2'))
+
+    return price_list
+
+
+def create_order(registry, items, price_list=None, code='SO-BENCH'):
+    order = registry.Sale.Order.create(channel="BENCH", code=code,
+                                       price_list=price_list)
+    for item in items:
+        registry.Sale.Order.Line.create(
+            order=order, item=item, quantity=2, unit_price=D('12.34'),
+            unit_tax=D('0.2'))
+
+    registry.flush()
+    return order
+
+
+@benchmark('compute_price', number=1000)
+def bench_compute_price(registry):
+    return lambda: compute_price(gross=D('12.34'), tax=D('0.2'))
+
+
+@benchmark('compute_discount', number=1000)
+def bench_compute_discount(registry):
+    price = compute_price(gross=D('12.34'), tax=D('0.2'))
+    return lambda: compute_discount(price=price, tax=D('0.2'),
+                                    discount_percent=D('0.1'),
+                                    from_gross=True)
+
+
+def bench_line_create(registry, with_price_list):
+    items = create_items(registry, 1)
+    price_list = None
+    if with_price_list:
+        price_list = create_price_list(registry, items)
+    order = create_order(registry, [], price_list=price_list)
+
+    def run():
+        registry.Sale.Order.Line.create(
+            order=order, item=items[0], quantity=2, unit_price=D('12.34'),
+            unit_tax=D('0.2'))
+        registry.flush()
+
+    return run
+
+
+@benchmark('line_create', number=100)
+def bench_line_create_without_price_list(registry):
+    return bench_line_create(registry, False)
+
+
+@benchmark('line_create_price_list', number=100)
+def bench_line_create_with_price_list(registry):
+    return bench_line_create(registry, True)
+
+
+def bench_line_compute(registry, with_price_list):
+    items = create_items(registry, 1)
+    price_list = None
+    if with_price_list:
+        price_list = create_price_list(registry, items)
+    line = create_order(registry, items, price_list=price_list).lines[0]
+    return line.compute
+
+
+@benchmark('line_compute', number=100)
+def bench_line_compute_without_price_list(registry):
+    return bench_line_compute(registry, False)
+
+
+@benchmark('line_compute_price_list', number=100)
+def bench_line_compute_with_price_list(registry):
+    return bench_line_compute(registry, True)
+
+
+def bench_order_compute(registry, count):
+    items = create_items(registry, count)
+    order = create_order(registry, items)
+    registry.expire_all()
+
+    def run():
+        order.compute()
+        registry.flush()
+
+    return run
+
+
+for count in (10, 100, 1000):
+    benchmark('order_compute_%d' % count)(
+        lambda registry, count=count: bench_order_compute(registry, count))
+
+
+@benchmark('order_transitions', number=10)
+def bench_order_transitions(registry):
+    items = create_items(registry, 10)
+    orders = iter([create_order(registry, items, code="SO-BENCH-%d" % i)
+                   for i in range(5 * 10)])
+    registry.expire_all()
+
+    def run():
+        order = next(orders)
+        order.state_to('quotation')
+        order.state_to('order')
+
+    return run
+
+
+@benchmark('pricelist_item_create', number=100)
+def bench_pricelist_item_create(registry):
+    items = iter(create_items(registry, 5 * 100))
+    price_list = create_price_list(registry, [])
+
+    def run():
+        registry.Sale.PriceList.Item.create(
+            price_list=price_list, item=next(items), unit_price=D('12.34'),
+            unit_tax=D('0.2'))
+        registry.flush()
+
+    return run
+
+
+@benchmark('order_search', number=10)
+def bench_order_search(registry):
+    """Search one order among the orders of a dataset generated by
+    anyblok_sale_generate_dataset
+
+    With ``--benchmark-search-orders`` the missing dataset orders are
+    generated in the savepoint of the benchmark, which is slow for large
+    counts. Without a dataset nor this option the benchmark is skipped
+    """
+    count = Configuration.get('benchmark_search_orders')
+    Order = registry.Sale.Order
+    existing = Order.query().filter(Order.code.like('SO-DATASET-%')).count()
+    if count is None:
+        if not existing:
+            return None
+
+        count = existing
+    elif existing < count:
+        generator = DatasetGenerator(registry, chunk_size=10000,
+                                     autocommit=False)
+        price_lists = generator.create_price_lists(1, 100,
+                                                   prefix='BENCH-SEARCH')
+        generator.create_orders(count - existing, price_lists,
+                                first_number=existing)
+        registry.execute(text("ANALYZE sale_order"))
+
+    value = 'DATASET-%08d' % (count // 2)
+    # warm up the table and index pages before the measures
+    Order.search(value)
+    return lambda: Order.search(value)
+
+
+@benchmark('line_amount_aggregate', number=10)
+def bench_line_amount_aggregate(registry):
+    Line = registry.Sale.Order.Line
+    items = create_items(registry, 100)
+    for i in range(10):
+        create_order(registry, items, code="SO-BENCH-%d" % i)
+
+    query = registry.query(Line.order_uuid, func.sum(Line.amount_untaxed),
+                           func.sum(Line.amount_tax),
+                           func.sum(Line.amount_total))
+    query = query.group_by(Line.order_uuid)
+    return query.all
+
+
+def measure(run, number=1, repeat=5):
+    """Time ``repeat`` measures of ``number`` calls of run
+
+    :return: statistics in seconds per call
+    """
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            run()
+
+        timings.append((perf_counter() - start) / number)
+
+    return OrderedDict((('min', min(timings)), ('median', median(timings)),
+                        ('mean', mean(timings)), ('max', max(timings)),
+                        ('number', number), ('repeat', repeat)))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(registry, names=None):
+    """Run the benchmarks and return the results
+
+    :param registry: registry with the sale blok installed
+    :param names: benchmark names to run, all if None
+    :return: dict with the run metadata and the statistics per benchmark,
+             the skipped benchmarks are missing
+    """
+    results = OrderedDict()
+    for name, (prepare, number, repeat) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+
+        savepoint = registry.begin_nested()
+        try:
+            run = prepare(registry)
+            if run is not None:
+                results[name] = measure(run, number=number, repeat=repeat)
+        finally:
+            savepoint.rollback()
+            registry.expunge_all()
+
+    is_installed = registry.System.Blok.is_installed
+    return OrderedDict((
+        ('date', datetime.now().isoformat()),
+        ('commit', get_commit()),
+        ('python', platform.python_version()),
+        ('amount_storage', ('minor_units'
+                            if is_installed('sale_minor_units')
+                            else 'numeric')),
+        ('benchmarks', results),
+    ))
+
+
+def dump_results(results, path):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2)
@@ -20,6 +20,10 @@ class CustomerSaleBlok(Blok):
 
     required = ['sale', 'customer', 'address']
 
+    def update(self, latest_version):
+        self.registry.Sale.Order.create_trigram_indexes()
+        self.registry.Address.update_content_hash()
+
     @classmethod
     def import_declaration_module(cls):
         from . import model # noqa
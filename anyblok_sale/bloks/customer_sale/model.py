@@ -6,8 +6,13 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 # -*- coding: utf-8 -*-
+from hashlib import sha256
+
+from sqlalchemy import Index, bindparam, or_, select
 
 from anyblok import Declarations
+from anyblok.declarations import classmethod_cache
+from anyblok.column import String
 from anyblok.relationship import Many2One
 
 from anyblok_mixins.workflow.marshmallow import SchemaValidator
@@ -16,12 +21,192 @@ from anyblok_marshmallow import fields, SchemaWrapper
 from anyblok_sale.bloks.sale.model import (
         OrderLineBaseSchema,
 )
+from anyblok_sale.bloks.sale_base.base import invalidate_cache_from_orm_event
+from anyblok_sale.bloks.sale_base.stats import TimedValidator
 
 from marshmallow.validate import Length
 
 
 Mixin = Declarations.Mixin
 
+ADDRESS_HASH_FIELDS = ('first_name', 'last_name', 'company_name', 'street1',
+                       'street2', 'street3', 'zip_code', 'state', 'city',
+                       'country', 'phone1', 'phone2', 'email')
+
+
+def compute_address_hash(**data):
+    """Compute a stable content hash for an address
+
+    Values are normalized (stripped, case folded, country and phone number
+    objects reduced to their code) so that two addresses holding the same
+    postal information get the same hash.
+
+    :param data: address values, missing fields are considered empty
+    :return: sha256 hexdigest
+    :rtype: string
+
+    :Example:
+
+    >>> compute_address_hash(first_name="John", last_name="Doe",
+    >>>                      street1="1 Esplanade", city="Puteaux",
+    >>>                      country="FRA") == compute_address_hash(
+    >>>     first_name=" john", last_name="DOE", street1="1 esplanade",
+    >>>     city="Puteaux ", country="fra")
+    >>> True
+    """
+    values = []
+    for field in ADDRESS_HASH_FIELDS:
+        value = data.get(field)
+        if value is None:
+            value = ''
+        elif hasattr(value, 'alpha_3'):
+            value = value.alpha_3
+        elif hasattr(value, 'e164'):
+            value = value.e164
+        values.append(str(value).strip().casefold())
+
+    return sha256('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+
+@Declarations.register(Declarations.Model)
+class Address:
+    """Overrides Address model in order to add a content hash used to reuse
+    identical addresses instead of inserting duplicates
+
+    The addresses shared by ``get_or_create`` are read only, editing one of
+    them would change the address of every order referencing it. Only the
+    addresses created by ``get_or_create`` are deduplicated, the existing
+    editable addresses get a content hash but are neither reused nor merged
+    """
+
+    content_hash = String(label="Content hash", index=True)
+
+    def get_content_hash(self):
+        return compute_address_hash(
+            **{field: getattr(self, field, None)
+               for field in ADDRESS_HASH_FIELDS})
+
+    @classmethod
+    def get_or_create(cls, **kwargs):
+        """Return an existing read only address with the same content or
+        insert a new read only one
+
+        Editable addresses are never reused, to change the address of an
+        order give it another address
+
+        :param kwargs: address values
+        :return: Address instance
+        """
+        address = cls.query().filter_by(
+            content_hash=compute_address_hash(**kwargs),
+            readonly=True).first()
+        if address is None:
+            address = cls.insert(readonly=True, **kwargs)
+
+        return address
+
+    @classmethod
+    def update_content_hash(cls, batch_size=1000):
+        """Compute the content hash of the addresses inserted without it
+
+        The addresses are read by keyset pagination on the primary key. The
+        hashed addresses stay editable, so they are not reused by
+        ``get_or_create``: the duplicates existing before the hash are kept
+
+        :param batch_size: number of addresses updated per statement
+        :return: number of updated addresses
+        """
+        table = cls.__table__
+        query = select(
+            [table.c.uuid] + [table.c[field] for field in ADDRESS_HASH_FIELDS]
+        ).where(table.c.content_hash.is_(None)).order_by(
+            table.c.uuid).limit(batch_size)
+        update = table.update().where(
+            table.c.uuid == bindparam('address_uuid')).values(
+            content_hash=bindparam('address_hash'))
+
+        count = 0
+        last = None
+        while True:
+            batch = query if last is None else query.where(
+                table.c.uuid > last)
+            rows = cls.registry.execute(batch).fetchall()
+            if not rows:
+                return count
+
+            last = rows[-1][table.c.uuid]
+            cls.registry.execute(update, [
+                {'address_uuid': row[table.c.uuid],
+                 'address_hash': compute_address_hash(
+                     **{field: row[table.c[field]]
+                        for field in ADDRESS_HASH_FIELDS})}
+                for row in rows])
+            count += len(rows)
+
+    @classmethod
+    def before_insert_orm_event(cls, mapper, connection, target):
+        target.content_hash = target.get_content_hash()
+
+    @classmethod
+    def before_update_orm_event(cls, mapper, connection, target):
+        super(Address, cls).before_update_orm_event(mapper, connection,
+                                                    target)
+        target.content_hash = target.get_content_hash()
+
+
+@Declarations.register(Declarations.Model)
+class Sale:
+
+    @classmethod
+    def get_metrics_caches(cls):
+        caches = super(Sale, cls).get_metrics_caches()
+        caches['sale.customer.price_list'] = (
+            cls.registry.Sale.Customer.get_price_list_uuid.cache_info())
+        return caches
+
+
+@Declarations.register(Declarations.Model.Sale)
+class Customer:
+    """Overrides Sale.Customer model in order to add a default price list
+    applied on the customer orders
+    """
+
+    price_list = Many2One(label="Default price list",
+                          model=Declarations.Model.Sale.PriceList)
+
+    @classmethod_cache()
+    def get_price_list_uuid(cls, customer_uuid):
+        """Return the uuid of the default price list of a customer
+
+        The mapping is cached and invalidated when the price list of a
+        customer changes
+        """
+        return cls.query('price_list_uuid').filter_by(
+            uuid=customer_uuid).scalar()
+
+    @classmethod
+    def get_default_price_list(cls, customer):
+        """Return the default price list of a customer
+
+        Loads the price list when it is not in the session, use
+        ``get_price_list_uuid`` when the primary key is enough
+        """
+        price_list_uuid = cls.get_price_list_uuid(customer.uuid)
+        if price_list_uuid is None:
+            return None
+
+        return cls.registry.Sale.PriceList.query().get(price_list_uuid)
+
+    @classmethod
+    def after_update_orm_event(cls, mapper, connection, target):
+        modified_fields = target.get_modified_fields()
+        if ('price_list' not in modified_fields and
+                'price_list_uuid' not in modified_fields):
+            return
+
+        invalidate_cache_from_orm_event(connection, cls,
+                                        'get_price_list_uuid')
+
 
 class OrderBaseSchema(SchemaWrapper):
     model = "Model.Sale.Order"
@@ -45,6 +230,13 @@ class Order:
     def get_schema_definition(cls, **kwargs):
         return cls.SCHEMA(**kwargs)
 
+    @classmethod
+    def define_table_args(cls):
+        table_args = super(Order, cls).define_table_args()
+        return table_args + (
+            Index('sale_order_customer_uuid_idx', 'customer_uuid'),
+        )
+
     @classmethod
     def get_workflow_definition(cls):
 
@@ -55,20 +247,24 @@ class Order:
             },
             'quotation': {
                 'allowed_to': ['order', 'cancelled'],
-                'validators': SchemaValidator(cls.get_schema_definition(
-                    exclude=[
-                        'customer',
-                        'price_list',
-                        'customer_address',
-                        'delivery_address']))
+                'validators': TimedValidator(
+                    cls, 'sale.order.validator.quotation',
+                    SchemaValidator(cls.get_schema_definition(
+                        exclude=[
+                            'customer',
+                            'price_list',
+                            'customer_address',
+                            'delivery_address'])))
             },
             'order': {
-                'validators': SchemaValidator(cls.get_schema_definition(
-                    exclude=[
-                        'customer',
-                        'price_list',
-                        'customer_address',
-                        'delivery_address']))
+                'validators': TimedValidator(
+                    cls, 'sale.order.validator.order',
+                    SchemaValidator(cls.get_schema_definition(
+                        exclude=[
+                            'customer',
+                            'price_list',
+                            'customer_address',
+                            'delivery_address'])))
             },
             'cancelled': {},
         }
@@ -82,17 +278,79 @@ class Order:
                                 model=Declarations.Model.Address)
 
     @classmethod
-    def create(cls, price_list=None, **kwargs):
-        data = kwargs.copy()
-        if cls.get_schema_definition:
-            sch = cls.get_schema_definition(
-                        registry=cls.registry,
-                        exclude=['lines', 'customer', 'customer_address',
-                                 'delivery_address']
-            )
-            if price_list:
-                data["price_list"] = price_list.to_primary_keys()
-            data = sch.load(data)
-            data['price_list'] = price_list
-
-        return cls.insert(**data)
+    def get_trigram_indexes(cls):
+        indexes = super(Order, cls).get_trigram_indexes()
+        indexes.update({
+            'sale_customer_email_trgm_idx': ('sale_customer', 'email'),
+            'sale_customer_first_name_trgm_idx': ('sale_customer',
+                                                  'first_name'),
+            'sale_customer_last_name_trgm_idx': ('sale_customer',
+                                                 'last_name'),
+        })
+        return indexes
+
+    @classmethod
+    def get_search_columns(cls):
+        Customer = cls.registry.Sale.Customer
+        return super(Order, cls).get_search_columns() + [
+            Customer.email, Customer.first_name, Customer.last_name]
+
+    @classmethod
+    def get_search_query(cls):
+        return super(Order, cls).get_search_query().outerjoin(cls.customer)
+
+    @classmethod
+    def get_search_subqueries(cls, pattern):
+        table = cls.__table__
+        customer = cls.registry.Sale.Customer.__table__
+        customers = select([customer.c.uuid]).where(or_(
+            *[customer.c[column].ilike(pattern, escape='\\')
+              for column in ('email', 'first_name', 'last_name')]))
+        return super(Order, cls).get_search_subqueries(pattern) + [
+            select([table.c.uuid]).where(
+                table.c.customer_uuid.in_(customers))]
+
+    @classmethod
+    def get_address(cls, address):
+        """Resolve an address given as a dict of values to an existing
+        identical address, or a new one
+        """
+        if isinstance(address, dict):
+            return cls.registry.Address.get_or_create(**address)
+
+        return address
+
+    @classmethod
+    def get_create_schema_exclude(cls):
+        return super(Order, cls).get_create_schema_exclude() + [
+            'customer', 'customer_address', 'delivery_address']
+
+    @classmethod
+    def get_create_values(cls, price_list=None, customer=None,
+                          customer_address=None, delivery_address=None,
+                          **kwargs):
+        """Return the values of a new order, the price list defaults to
+        the customer one and the addresses given as dict are resolved by
+        ``Address.get_or_create``
+
+        The default price list is set by its cached uuid, it is only loaded
+        when the order lines read it
+        """
+        price_list_uuid = None
+        if price_list is None and customer is not None:
+            price_list_uuid = cls.registry.Sale.Customer.get_price_list_uuid(
+                customer.uuid)
+
+        data = super(Order, cls).get_create_values(price_list=price_list,
+                                                   **kwargs)
+        if price_list_uuid is not None:
+            data.pop('price_list', None)
+            data['price_list_uuid'] = price_list_uuid
+        if customer is not None:
+            data['customer'] = customer
+        if customer_address is not None:
+            data['customer_address'] = cls.get_address(customer_address)
+        if delivery_address is not None:
+            data['delivery_address'] = cls.get_address(delivery_address)
+
+        return data
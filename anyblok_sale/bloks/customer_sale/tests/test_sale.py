@@ -8,6 +8,11 @@
 # -*- coding: utf-8 -*-
 
 from anyblok.tests.testcase import BlokTestCase
+from anyblok_mixins.mixins.exceptions import ForbidUpdateException
+
+from anyblok_sale.bloks.sale_base.tracing import (
+    InMemoryTracer, register_tracer, unregister_tracer)
+from anyblok_sale.testing import QueryCounter
 
 
 class TestSaleOrderModel(BlokTestCase):
@@ -44,3 +49,166 @@ class TestSaleOrderModel(BlokTestCase):
 
         so.delivery_address = address
         self.assertEqual(so.delivery_address, address)
+
+    def test_create_customer_sale_order_reuse_address(self):
+        address_data = dict(
+                first_name="John", last_name="Doe",
+                street1="1 Esplanade de la défense",
+                street2="Grande Arche de la Défense", street3="Paroi Nord",
+                zip_code="92800", city="Puteaux", country="FRA",
+                state="Ile de France"
+                )
+
+        so1 = self.registry.Sale.Order.create(
+                                channel="WEBSITE",
+                                code="SO-TEST-000001",
+                                customer_address=address_data,
+                                delivery_address=address_data,
+                            )
+        so2 = self.registry.Sale.Order.create(
+                                channel="WEBSITE",
+                                code="SO-TEST-000002",
+                                customer_address=dict(address_data,
+                                                      city=" puteaux"),
+                            )
+
+        self.assertEqual(self.registry.Address.query().count(), 1)
+        self.assertEqual(so1.customer_address, so1.delivery_address)
+        self.assertEqual(so1.customer_address, so2.customer_address)
+        self.assertIsNone(so2.delivery_address)
+
+    def test_address_content_hash_updated(self):
+        address = self.registry.Address.insert(
+                first_name="John", last_name="Doe", street1="1 rue",
+                city="Puteaux", country="FRA")
+        content_hash = address.content_hash
+        self.assertIsNotNone(content_hash)
+
+        address.street1 = "2 rue"
+        self.registry.flush()
+        self.assertNotEqual(address.content_hash, content_hash)
+
+        # editable addresses are not shared
+        shared = self.registry.Address.get_or_create(
+                first_name="John", last_name="Doe", street1="2 rue",
+                city="Puteaux", country="FRA")
+        self.assertNotEqual(shared, address)
+        self.assertTrue(shared.readonly)
+        self.assertEqual(shared.content_hash, address.content_hash)
+
+    def test_shared_address_readonly(self):
+        address_data = dict(first_name="John", last_name="Doe",
+                            street1="1 rue", city="Puteaux", country="FRA")
+        so1 = self.registry.Sale.Order.create(
+                channel="WEBSITE", code="SO-TEST-000001",
+                customer_address=address_data)
+        so2 = self.registry.Sale.Order.create(
+                channel="WEBSITE", code="SO-TEST-000002",
+                customer_address=address_data)
+        self.assertEqual(so1.customer_address, so2.customer_address)
+
+        so1.customer_address.street1 = "2 rue"
+        with self.assertRaises(ForbidUpdateException):
+            self.registry.flush()
+
+    def test_update_content_hash(self):
+        Address = self.registry.Address
+        values = dict(first_name="John", last_name="Doe", street1="1 rue",
+                      city="Puteaux", country="FRA")
+        address = Address.insert(**values)
+        other = Address.insert(**dict(values, street1="2 rue"))
+        content_hash = address.content_hash
+        self.registry.flush()
+        self.registry.execute(Address.__table__.update().values(
+            content_hash=None))
+        self.registry.expire_all()
+
+        self.assertEqual(Address.update_content_hash(batch_size=1), 2)
+        self.registry.expire_all()
+        self.assertEqual(address.content_hash, content_hash)
+        self.assertIsNotNone(other.content_hash)
+        # existing editable addresses are not reused
+        self.assertNotEqual(Address.get_or_create(**values), address)
+
+    def test_create_customer_sale_order_default_price_list(self):
+        price_list = self.registry.Sale.PriceList.create(code="PRO",
+                                                         name="Pro")
+        other_price_list = self.registry.Sale.PriceList.create(
+                code="DEFAULT", name="Default")
+        customer = self.registry.Sale.Customer.create(
+                email="john.doe@zeprofile.com", first_name="John",
+                last_name="Doe", phone="+33602030405"
+                )
+
+        so = self.registry.Sale.Order.create(
+                channel="WEBSITE", code="SO-TEST-000001", customer=customer)
+        self.assertEqual(so.customer, customer)
+        self.assertIsNone(so.price_list)
+
+        customer.price_list = price_list
+        self.registry.flush()
+
+        so = self.registry.Sale.Order.create(
+                channel="WEBSITE", code="SO-TEST-000002", customer=customer)
+        self.assertEqual(so.price_list, price_list)
+
+        so = self.registry.Sale.Order.create(
+                channel="WEBSITE", code="SO-TEST-000003", customer=customer,
+                price_list=other_price_list)
+        self.assertEqual(so.price_list, other_price_list)
+
+    def test_create_customer_sale_order_price_list_not_loaded(self):
+        price_list = self.registry.Sale.PriceList.create(code="PRO",
+                                                         name="Pro")
+        customer = self.registry.Sale.Customer.create(
+                email="john.doe@zeprofile.com", first_name="John",
+                last_name="Doe", phone="+33602030405",
+                price_list=price_list)
+        self.registry.flush()
+        price_list_uuid = price_list.uuid
+        self.registry.Sale.Customer.get_price_list_uuid(customer.uuid)
+        customer_uuid = customer.uuid
+        self.registry.expunge_all()
+
+        customer = self.registry.Sale.Customer.query().get(customer_uuid)
+        with QueryCounter(self.registry) as counter:
+            so = self.registry.Sale.Order.create(
+                    channel="WEBSITE", code="SO-TEST-000001",
+                    customer=customer)
+
+        self.assertFalse([statement for statement in counter.statements
+                          if 'FROM sale_pricelist' in statement])
+        self.assertEqual(so.price_list_uuid, price_list_uuid)
+
+    def test_create_customer_sale_order_span(self):
+        price_list = self.registry.Sale.PriceList.create(code="PRO",
+                                                         name="Pro")
+        customer = self.registry.Sale.Customer.create(
+                email="john.doe@zeprofile.com", first_name="John",
+                last_name="Doe", phone="+33602030405",
+                price_list=price_list)
+
+        tracer = InMemoryTracer()
+        register_tracer(tracer)
+        self.addCleanup(unregister_tracer)
+        so = self.registry.Sale.Order.create(
+                channel="WEBSITE", code="SO-TEST-000001", customer=customer)
+
+        create, = tracer.get_spans('sale.order.create')
+        self.assertEqual(create.attributes, {
+            'channel': "WEBSITE", 'price_list': str(price_list.uuid),
+            'order_uuid': str(so.uuid)})
+
+    def test_search_customer_sale_order(self):
+        customer = self.registry.Sale.Customer.create(
+                email="john.doe@zeprofile.com", first_name="John",
+                last_name="Doe", phone="+33602030405"
+                )
+        so1 = self.registry.Sale.Order.create(
+                channel="WEBSITE", code="SO-TEST-000001", customer=customer)
+        so2 = self.registry.Sale.Order.create(
+                channel="WEBSITE", code="SO-TEST-000002")
+
+        self.assertEqual(self.registry.Sale.Order.search("zeprofile"), [so1])
+        self.assertEqual(self.registry.Sale.Order.search("doe"), [so1])
+        self.assertEqual(self.registry.Sale.Order.search("000002"), [so2])
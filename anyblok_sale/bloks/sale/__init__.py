@@ -8,6 +8,7 @@
 # -*- coding: utf-8 -*-
 
 from anyblok.blok import Blok
+from anyblok.version import parse_version
 from logging import getLogger
 logger = getLogger(__name__)
 
@@ -15,12 +16,22 @@ logger = getLogger(__name__)
 class SaleBlok(Blok):
     """Sale blok
     """
-    version = "0.1.0"
+    version = "0.1.1"
     author = "Franck BRET"
 
     required = ['anyblok-core', 'anyblok-workflow', 'anyblok-mixins',
                 'sale_base', 'pricelist', 'attachment', 'product_item']
 
+    def update(self, latest_version):
+        self.registry.Sale.Order.create_trigram_indexes()
+        self.registry.Sale.Order.Line.update_properties_hash()
+        # line_count, total_quantity and tax_breakdown are added by 0.1.1,
+        # the migration may fill them with a default on the existing orders
+        upgrade = (latest_version is not None and
+                   latest_version < parse_version('0.1.1'))
+        self.registry.Sale.Order.update_line_totals(all_orders=upgrade)
+        self.registry.Sale.Order.update_tax_breakdown(all_orders=upgrade)
+
     @classmethod
     def import_declaration_module(cls):
         from . import model # noqa
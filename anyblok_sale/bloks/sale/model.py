@@ -7,14 +7,32 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 # -*- coding: utf-8 -*-
 
+import csv
+import json
+from datetime import datetime, timedelta
 from decimal import Decimal as D
+from hashlib import sha256
+from itertools import groupby
+from logging import getLogger
+from marshmallow.exceptions import ValidationError
 from marshmallow.validate import Length
+from sqlalchemy import (
+    Index, bindparam, case, cast, func, literal, null, or_, select, text,
+    tuple_, union)
+from sqlalchemy.dialects.postgresql import (
+    TIMESTAMP, aggregate_order_by, insert)
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm import deferred, joinedload, subqueryload, undefer
 
 from anyblok import Declarations
-from anyblok.column import String, Decimal, Integer
+from anyblok.config import Configuration
+from anyblok.declarations import classmethod_cache
+from anyblok.column import String, Decimal, Integer, Date
 from anyblok.relationship import Many2One
 
 from anyblok_postgres.column import Jsonb
+from anyblok_mixins.workflow.exceptions import WorkFlowException
 from anyblok_mixins.workflow.marshmallow import SchemaValidator
 from anyblok_marshmallow import fields, SchemaWrapper
 
@@ -22,10 +40,33 @@ from anyblok_sale.bloks.sale_base.base import (
     compute_tax,
     compute_price,
     compute_discount)
+from anyblok_sale.bloks.sale_base.stats import (
+    TimedValidator, incr, timed)
+from anyblok_sale.bloks.sale_base.tracing import traced
 
 
+logger = getLogger(__name__)
 Mixin = Declarations.Mixin
 
+EXPORT_ORDER_FIELDS = ('uuid', 'code', 'channel', 'state', 'create_date',
+                       'edit_date', 'delivery_method', 'amount_untaxed',
+                       'amount_tax', 'amount_total')
+EXPORT_LINE_FIELDS = ('uuid', 'quantity', 'unit_price_untaxed', 'unit_price',
+                      'unit_tax', 'amount_untaxed', 'amount_tax',
+                      'amount_total', 'amount_discount_percentage_untaxed',
+                      'amount_discount_percentage', 'amount_discount_untaxed',
+                      'amount_discount', 'properties')
+
+COLUMNAR_AMOUNT_FIELDS = ('unit_price_untaxed', 'unit_price', 'unit_tax',
+                          'amount_untaxed', 'amount_tax', 'amount_total',
+                          'amount_discount_percentage_untaxed',
+                          'amount_discount_percentage',
+                          'amount_discount_untaxed', 'amount_discount')
+COLUMNAR_AMOUNT_SCALE = 4
+
+SUMMARY_FIELDS = ('create_date', 'channel', 'state', 'amount_untaxed',
+                  'amount_tax', 'amount_total')
+
 
 class OrderLineBaseSchema(SchemaWrapper):
     model = "Model.Sale.Order.Line"
@@ -44,6 +85,53 @@ class LineException(Exception):
     pass
 
 
+class DeferredJsonb(Jsonb):
+    """PostgreSQL JSONB column not loaded with the row but on first access
+    (SQLAlchemy deferred column)
+    """
+
+    def get_sqlalchemy_mapping(self, registry, namespace, fieldname,
+                               properties):
+        return deferred(super(DeferredJsonb, self).get_sqlalchemy_mapping(
+            registry, namespace, fieldname, properties))
+
+
+def compute_properties_hash(item_keys, properties):
+    """Compute a stable hash of a product item and line properties
+
+    :param item_keys: primary keys of the item as a dict
+    :param properties: line properties
+    :return: sha256 hexdigest
+    :rtype: string
+    """
+    value = json.dumps([sorted(item_keys.items()), properties or {}],
+                       sort_keys=True, separators=(',', ':'), default=str)
+    return sha256(value.encode('utf-8')).hexdigest()
+
+
+def escape_like(value, escape='\\'):
+    """Escape the LIKE wildcards of a user given search string
+
+    :Example:
+
+    >>> escape_like('50%_off')
+    >>> '50\\%\\_off'
+    """
+    return value.replace(escape, escape * 2).replace(
+        '%', escape + '%').replace('_', escape + '_')
+
+
+@Declarations.register(Declarations.Model)
+class Sale:
+
+    @classmethod
+    def get_metrics_caches(cls):
+        caches = super(Sale, cls).get_metrics_caches()
+        caches['sale.order.line.properties_schema'] = (
+            cls.registry.Sale.Order.Line.get_properties_schema.cache_info())
+        return caches
+
+
 @Declarations.register(Declarations.Model.Sale)
 class Order(Mixin.UuidColumn, Mixin.TrackModel, Mixin.WorkFlow):
     """Sale.Order model
@@ -64,18 +152,38 @@ class Order(Mixin.UuidColumn, Mixin.TrackModel, Mixin.WorkFlow):
             },
             'quotation': {
                 'allowed_to': ['order', 'cancelled'],
-                'validators': SchemaValidator(cls.get_schema_definition(
-                    exclude=[
-                        'price_list']))
+                'validators': TimedValidator(
+                    cls, 'sale.order.validator.quotation',
+                    SchemaValidator(cls.get_schema_definition(
+                        exclude=['price_list'])))
             },
             'order': {
-                'validators': SchemaValidator(cls.get_schema_definition(
-                    exclude=[
-                        'price_list']))
+                'validators': TimedValidator(
+                    cls, 'sale.order.validator.order',
+                    SchemaValidator(cls.get_schema_definition(
+                        exclude=['price_list'])))
             },
             'cancelled': {},
         }
 
+    @classmethod
+    def define_mapper_args(cls):
+        """Check the order version on each UPDATE/DELETE, an order modified
+        by another transaction since it was loaded raises
+        ``sqlalchemy.orm.exc.StaleDataError`` on flush
+        """
+        mapper_args = super(Order, cls).define_mapper_args()
+        mapper_args['version_id_col'] = cls.__table__.c.version
+        return mapper_args
+
+    @classmethod
+    def define_table_args(cls):
+        table_args = super(Order, cls).define_table_args()
+        return table_args + (
+            Index('sale_order_state_create_date_idx', 'state',
+                  'create_date'),
+        )
+
     code = String(label="Code", nullable=False)
     channel = String(label="Sale Channel", nullable=False)
     price_list = Many2One(label="Price list",
@@ -86,6 +194,11 @@ class Order(Mixin.UuidColumn, Mixin.TrackModel, Mixin.WorkFlow):
     amount_tax = Decimal(label="Tax amount", default=D(0))
     amount_total = Decimal(label="Total", default=D(0))
 
+    version = Integer(label="Version", default=1, nullable=False)
+    line_count = Integer(label="Line count", default=0)
+    total_quantity = Integer(label="Total quantity", default=0)
+    tax_breakdown = Jsonb(label="Tax breakdown")
+
     def __str__(self):
         return "{self.uuid} {self.channel} {self.code} {self.state}".format(
             self=self)
@@ -99,34 +212,693 @@ class Order(Mixin.UuidColumn, Mixin.TrackModel, Mixin.WorkFlow):
                     self=self)
 
     @classmethod
-    def create(cls, price_list=None, **kwargs):
+    @traced('sale.order.create',
+            attributes=lambda cls, **kwargs: {
+                'channel': kwargs.get('channel')},
+            result_attributes=lambda order: {
+                'order_uuid': str(order.uuid),
+                'price_list': (order.price_list_uuid and
+                               str(order.price_list_uuid))})
+    @timed('sale.order.create')
+    def create(cls, **kwargs):
+        """Insert an order with the values returned by
+        ``get_create_values``
+        """
+        return cls.insert(**cls.get_create_values(**kwargs))
+
+    @classmethod
+    def get_create_schema_exclude(cls):
+        """Return the schema fields not loaded by ``get_create_values``"""
+        return ['lines']
+
+    @classmethod
+    def get_create_values(cls, price_list=None, **kwargs):
+        """Return the values of a new order loaded by the order schema"""
         data = kwargs.copy()
         if cls.get_schema_definition:
             sch = cls.get_schema_definition(
                         registry=cls.registry,
-                        exclude=['lines']
+                        exclude=cls.get_create_schema_exclude()
             )
             if price_list:
                 data["price_list"] = price_list.to_primary_keys()
             data = sch.load(data)
             data['price_list'] = price_list
 
-        return cls.insert(**data)
+        return data
+
+    @classmethod_cache()
+    def has_pg_trgm(cls):
+        """Return True if the pg_trgm extension is installed"""
+        query = text("SELECT count(*) FROM pg_extension "
+                     "WHERE extname = 'pg_trgm'")
+        return bool(cls.registry.execute(query).scalar())
+
+    @classmethod
+    def get_trigram_indexes(cls):
+        """Return the trigram GIN indexes used by ``search`` as a dict
+        {index name: (table name, column name)}
+        """
+        return {
+            'sale_order_code_trgm_idx': ('sale_order', 'code'),
+        }
+
+    @classmethod
+    def create_trigram_indexes(cls):
+        """Create the pg_trgm extension and the trigram indexes used by
+        ``search`` when the extension is available on the server
+        """
+        query = text("SELECT count(*) FROM pg_available_extensions "
+                     "WHERE name = 'pg_trgm'")
+        if not cls.registry.execute(query).scalar():
+            logger.warning("pg_trgm extension is not available, order "
+                           "search will not use trigram indexes")
+            return False
+
+        savepoint = cls.registry.begin_nested()
+        try:
+            cls.registry.execute(text(
+                "CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            savepoint.commit()
+        except ProgrammingError as e:
+            savepoint.rollback()
+            logger.warning("pg_trgm extension can not be created: %s", e)
+            return False
+
+        for name, (table, column) in cls.get_trigram_indexes().items():
+            cls.registry.execute(text(
+                "CREATE INDEX IF NOT EXISTS {name} ON {table} "
+                "USING gin ({column} gin_trgm_ops)".format(
+                    name=name, table=table, column=column)))
+
+        cls.registry.System.Cache.invalidate(cls, 'has_pg_trgm')
+        return True
+
+    @classmethod
+    def get_search_columns(cls):
+        """Return the columns used by ``search`` to rank the orders"""
+        return [cls.code]
+
+    @classmethod
+    def get_search_query(cls):
+        """Return the base query of ``search``, overload it to join the
+        tables of the columns returned by ``get_search_columns``
+        """
+        return cls.query()
+
+    @classmethod
+    def get_search_subqueries(cls, pattern):
+        """Return the selects of the uuids of the orders matching the
+        ``ILIKE`` pattern, overload it to search in other tables
+
+        Each select filters one table, so its ``ILIKE`` filters can be
+        served by the trigram indexes of this table, which is not possible
+        with one ``OR`` over the columns of joined tables
+        """
+        table = cls.__table__
+        return [select([table.c.uuid]).where(
+            table.c.code.ilike(pattern, escape='\\'))]
+
+    @classmethod
+    def search(cls, value, limit=20):
+        """Search orders which contain ``value`` in one of the search
+        columns
+
+        The uuids of the matching orders are selected by the union of
+        ``get_search_subqueries``, when pg_trgm is installed the ``ILIKE``
+        filters are served by the trigram GIN indexes and the result is
+        ranked by similarity
+
+        :param value: the searched string
+        :param limit: maximum number of orders returned
+        :return: list of orders, best match first
+        """
+        columns = cls.get_search_columns()
+        pattern = '%{}%'.format(escape_like(value))
+        subqueries = cls.get_search_subqueries(pattern)
+        uuids = (subqueries[0] if len(subqueries) == 1
+                 else union(*subqueries))
+        query = cls.get_search_query().filter(cls.uuid.in_(uuids))
+
+        if cls.has_pg_trgm():
+            rank = func.greatest(
+                *[func.similarity(column, value) for column in columns])
+            query = query.order_by(rank.desc())
+
+        return query.order_by(cls.create_date.desc()).limit(limit).all()
+
+    @classmethod
+    def get_export_query(cls, date_from=None, date_to=None, states=None):
+        """Return the query used by ``iter_export``, one row per order line
+        (or per order without line) ordered by order
+        """
+        Line = cls.registry.Sale.Order.Line
+        Item = cls.registry.Product.Item
+        columns = [getattr(cls, field).label('order_' + field)
+                   for field in EXPORT_ORDER_FIELDS]
+        columns.append(Item.code.label('line_item_code'))
+        columns.extend(getattr(Line, field).label('line_' + field)
+                       for field in EXPORT_LINE_FIELDS)
+
+        query = cls.registry.query(*columns).select_from(cls)
+        query = query.outerjoin(cls.lines).outerjoin(Line.item)
+        if date_from is not None:
+            query = query.filter(cls.create_date >= date_from)
+        if date_to is not None:
+            query = query.filter(cls.create_date < date_to)
+        if states:
+            query = query.filter(cls.state.in_(states))
+
+        return query.order_by(cls.create_date, cls.uuid, Line.create_date)
+
+    @classmethod
+    def iter_export(cls, batch_size=1000, **filters):
+        """Yield the orders with their lines as dicts
+
+        Orders and lines are read in the same query through a server side
+        cursor, ``batch_size`` rows at a time, without loading instances in
+        the session, so the memory does not grow with the number of exported
+        orders
+
+        :param batch_size: number of rows fetched per batch
+        :param filters: date_from, date_to and states, see
+            ``get_export_query``
+        :return: generator of dict
+        """
+        rows = cls.get_export_query(**filters).yield_per(batch_size)
+        for _, order_rows in groupby(rows, key=lambda row: row.order_uuid):
+            order = None
+            for row in order_rows:
+                if order is None:
+                    order = {field: getattr(row, 'order_' + field)
+                             for field in EXPORT_ORDER_FIELDS}
+                    order['lines'] = []
+                if row.line_uuid is not None:
+                    line = {field: getattr(row, 'line_' + field)
+                            for field in EXPORT_LINE_FIELDS}
+                    line['item_code'] = row.line_item_code
+                    order['lines'].append(line)
+
+            yield order
+
+    @classmethod
+    def export_jsonl(cls, fileobj, **kwargs):
+        """Write the orders with their lines as JSON Lines, one order per
+        line, see ``iter_export`` for the parameters
+
+        :return: number of exported orders
+        """
+        count = 0
+        for order in cls.iter_export(**kwargs):
+            fileobj.write(json.dumps(order, default=str))
+            fileobj.write('\n')
+            count += 1
+
+        return count
+
+    @classmethod
+    def export_csv(cls, fileobj, **kwargs):
+        """Write the orders as CSV, one row per order line with the order
+        columns repeated, see ``iter_export`` for the parameters
+
+        :return: number of exported orders
+        """
+        header = (['order_' + field for field in EXPORT_ORDER_FIELDS] +
+                  ['line_item_code'] +
+                  ['line_' + field for field in EXPORT_LINE_FIELDS])
+        writer = csv.writer(fileobj)
+        writer.writerow(header)
+        count = 0
+        for order in cls.iter_export(**kwargs):
+            order_values = [order[field] for field in EXPORT_ORDER_FIELDS]
+            for line in order['lines'] or [None]:
+                if line is None:
+                    line_values = [None] * (len(EXPORT_LINE_FIELDS) + 1)
+                else:
+                    line_values = [line['item_code']] + [
+                        json.dumps(line[field])
+                        if field == 'properties' else line[field]
+                        for field in EXPORT_LINE_FIELDS]
+                writer.writerow(order_values + line_values)
+            count += 1
+
+        return count
+
+    @classmethod
+    def get_lines_load_options(cls, with_properties=False, with_items=False):
+        """Return the loader options to load the lines of the queried orders
+        in one more query
+
+        :param with_properties: also load the deferred ``properties`` column
+        :param with_items: also load the product items of the lines
+        :return: list of options for ``query.options``
+
+        :Example:
+
+        >>> Order.query().options(
+        >>>     *Order.get_lines_load_options(with_items=True))
+        """
+        Line = cls.registry.Sale.Order.Line
+        options = [subqueryload(cls.lines)]
+        if with_properties:
+            options.append(subqueryload(cls.lines).undefer(Line.properties))
+        if with_items:
+            options.append(subqueryload(cls.lines).joinedload(Line.item))
+
+        return options
+
+    def get_lines_query(self, with_properties=False, with_items=False):
+        """Return the query of the lines of the order, the ``properties``
+        column is only loaded on access unless ``with_properties`` is True
+        """
+        Line = self.registry.Sale.Order.Line
+        query = Line.query().filter(Line.order == self)
+        if with_properties:
+            query = query.options(undefer(Line.properties))
+        if with_items:
+            query = query.options(joinedload(Line.item))
+
+        return query
+
+    def preload_lines(self):
+        """Load the lines of the order with their properties and product
+        items (and the item templates and families when product_family is
+        installed) in one query
+
+        Called before validating the lines on a state change, the lazy
+        loads of ``properties``, ``item``, ``item.template`` and
+        ``template.family`` done by ``Line.before_update_orm_event`` are then
+        served by the session identity map, so the number of queries does not
+        grow with the number of lines. ``compute`` only reads the amounts and
+        iterates ``lines``
+
+        :return: the lines of the order
+        """
+        Line = self.registry.Sale.Order.Line
+        option = joinedload(Line.item)
+        if Line.has_product_family():
+            Item = self.registry.Product.Item
+            Template = self.registry.Product.Template
+            option = option.joinedload(Item.template).joinedload(
+                Template.family)
+
+        return Line.query().filter(Line.order == self).options(
+            option, undefer(Line.properties)).all()
+
+    @traced('sale.order.state_to',
+            attributes=lambda order, new_state: {
+                'order_uuid': str(order.uuid), 'state': order.state,
+                'new_state': new_state})
+    def state_to(self, new_state):
+        self.preload_lines()
+        super(Order, self).state_to(new_state)
+        incr(self.registry, 'sale.order.transition.' + new_state)
+
+    @classmethod
+    def bulk_state_to(cls, orders, new_state, batch_size=1000):
+        """Change the state of many orders with set based UPDATEs
+
+        The transition and the validators of the new state are checked for
+        each order with one validator, the orders which pass are updated
+        together. An order updated by another transaction since it was
+        loaded (see ``version``) is not updated and reported in the errors.
+        ``Sale.Order.DailySummary`` is updated per day, channel and state
+
+        :param orders: Sale.Order instances
+        :param new_state: state to set
+        :param batch_size: number of orders validated and updated per query
+        :return: (updated order uuids, {order uuid: error})
+        """
+        definition = cls.get_workflow_definition()
+        if new_state not in definition:
+            raise WorkFlowException(
+                "Unknown state %r" % new_state)
+
+        cls.registry.flush()
+        validator = definition[new_state].get('validators')
+        table = cls.__table__
+        DailySummary = cls.registry.Sale.Order.DailySummary
+        updated = []
+        errors = {}
+        uuids = [order.uuid for order in orders]
+        for start in range(0, len(uuids), batch_size):
+            chunk = cls.query().filter(
+                cls.uuid.in_(uuids[start:start + batch_size])).options(
+                    *cls.get_lines_load_options(with_properties=True,
+                                                with_items=True)).all()
+
+            versions = {}
+            for order in chunk:
+                allowed_to = definition[order.state].get('allowed_to', [])
+                if new_state not in allowed_to:
+                    errors[order.uuid] = (
+                        "Transition from %r to %r is not allowed" % (
+                            order.state, new_state))
+                    continue
+
+                if validator is not None:
+                    try:
+                        validator(order)
+                    except ValidationError as error:
+                        errors[order.uuid] = error.messages
+                        continue
+
+                versions[order.uuid] = order
+
+            if not versions:
+                continue
+
+            query = table.update().where(
+                tuple_(table.c.uuid, table.c.version).in_(
+                    [(uuid, order.version)
+                     for uuid, order in versions.items()])).values(
+                state=new_state, version=table.c.version + 1,
+                edit_date=datetime.now()).returning(table.c.uuid)
+            chunk_updated = {
+                row[0] for row in cls.registry.execute(query)}
+
+            moved = []
+            for uuid, order in versions.items():
+                if uuid not in chunk_updated:
+                    errors[uuid] = "The order was modified concurrently"
+                    continue
+
+                moved.append(order.get_summary_values())
+                order.expire('state', 'version', 'edit_date')
+                updated.append(uuid)
+
+            DailySummary.move(cls.registry.connection(), moved, new_state)
+
+        incr(cls.registry, 'sale.order.transition.' + new_state, len(updated))
+        return updated, errors
+
+    @classmethod
+    def expire_quotations(cls, max_age, batch_size=500,
+                          states=('draft', 'quotation')):
+        """Cancel one chunk of the orders created more than ``max_age`` ago
+        and still in ``states``
+
+        The chunk is selected by the (state, create_date) index with
+        ``FOR UPDATE SKIP LOCKED``, orders locked by another transaction
+        are left for a next chunk, then cancelled by one UPDATE. Call it
+        in a loop, committing after each chunk, until it returns less than
+        ``batch_size``
+
+        :param max_age: timedelta
+        :param batch_size: maximum number of orders cancelled
+        :return: number of cancelled orders
+        """
+        cls.registry.flush()
+        table = cls.__table__
+        expired = select([table.c.uuid]).where(
+            table.c.state.in_(states)).where(
+            table.c.create_date < datetime.now() - max_age).order_by(
+            table.c.create_date).limit(batch_size).with_for_update(
+            skip_locked=True).alias('expired')
+        previous = table.alias('previous')
+
+        query = table.update().where(
+            table.c.uuid == expired.c.uuid).where(
+            previous.c.uuid == table.c.uuid).values(
+            state='cancelled', version=table.c.version + 1,
+            edit_date=datetime.now()).returning(
+            *[previous.c[field] for field in SUMMARY_FIELDS])
+        cancelled = [dict(zip(SUMMARY_FIELDS, row))
+                     for row in cls.registry.execute(query)]
+
+        cls.registry.Sale.Order.DailySummary.move(
+            cls.registry.connection(), cancelled, 'cancelled')
+        cls.registry.expire_all()
+        incr(cls.registry, 'sale.order.transition.cancelled', len(cancelled))
+        return len(cancelled)
+
+    @classmethod
+    def retry_on_conflict(cls, func, *args, retries=3, **kwargs):
+        """Call func in a savepoint and call it again when a concurrent
+        update of an order is detected
+
+        func must load the orders it modifies, they are expired before each
+        retry
+
+        :Example:
+
+        >>> def add_line(order_uuid, item):
+        ...     order = Order.query().get(order_uuid)
+        ...     Order.Line.create(order=order, item=item, quantity=1)
+        ...     order.compute()
+        >>> Order.retry_on_conflict(add_line, order_uuid, item)
+
+        :param retries: number of retries before raising StaleDataError
+        :return: result of func
+        """
+        for attempt in range(retries + 1):
+            savepoint = cls.registry.begin_nested()
+            try:
+                result = func(*args, **kwargs)
+                cls.registry.flush()
+                savepoint.commit()
+                return result
+            except StaleDataError:
+                savepoint.rollback()
+                cls.registry.expire_all()
+                if attempt == retries:
+                    raise
+
+                logger.debug("Sale.Order conflict, retry %d/%d",
+                             attempt + 1, retries)
+
+    def merge_duplicate_lines(self):
+        """Merge the lines of the order with the same item, properties,
+        unit prices and discount percentages into one line summing the
+        quantities
+
+        Lines with a discount amount or without properties hash (see
+        ``Line.update_properties_hash``) are never merged. The duplicates are
+        found, updated and deleted with set based queries, then the merged
+        lines and the order are computed again
+
+        :return: number of deleted lines
+        """
+        Line = self.registry.Sale.Order.Line
+        self.registry.flush()
+
+        query = self.registry.query(
+            func.array_agg(aggregate_order_by(Line.uuid, Line.create_date)),
+            func.sum(Line.quantity))
+        query = query.filter(Line.order == self,
+                             Line.properties_hash.isnot(None),
+                             Line.amount_discount_untaxed == D(0),
+                             Line.amount_discount == D(0))
+        query = query.group_by(*[column for column, _ in
+                                 Line.get_item_foreign_keys()])
+        query = query.group_by(Line.properties_hash, Line.unit_price_untaxed,
+                               Line.unit_price, Line.unit_tax,
+                               Line.amount_discount_percentage_untaxed,
+                               Line.amount_discount_percentage)
+        query = query.having(func.count() > 1)
+
+        quantities = {}
+        duplicates = []
+        for uuids, quantity in query:
+            quantities[uuids[0]] = quantity
+            duplicates.extend(uuids[1:])
+
+        if not duplicates:
+            return 0
+
+        Line.query().filter(Line.uuid.in_(duplicates)).delete(
+            synchronize_session='fetch')
+        Line.query().filter(Line.uuid.in_(quantities.keys())).update(
+            {Line.quantity: case(quantities, value=Line.uuid)},
+            synchronize_session='fetch')
+
+        self.expire('lines')
+        for line in self.lines:
+            if line.uuid in quantities:
+                line.compute()
+
+        self.compute()
+        return len(duplicates)
+
+    def get_summary_values(self, **values):
+        """Return the values of the order aggregated in
+        Sale.Order.DailySummary, ``values`` overwrite the instance values
+        """
+        res = {field: getattr(self, field) for field in SUMMARY_FIELDS}
+        res.update(values)
+        return res
+
+    @classmethod
+    def after_insert_orm_event(cls, mapper, connection, target):
+        cls.registry.Sale.Order.DailySummary.add(
+            connection, **target.get_summary_values())
+
+    @classmethod
+    def before_update_orm_event(cls, mapper, connection, target):
+        super(Order, cls).before_update_orm_event(mapper, connection, target)
+        modified_fields = {
+            field: value
+            for field, value in target.get_modified_fields().items()
+            if field in SUMMARY_FIELDS}
+        if not modified_fields:
+            return
+
+        if None in modified_fields.values():
+            # The previous value was not loaded in the session
+            table = cls.__table__
+            query = select([table.c[field] for field in SUMMARY_FIELDS])
+            query = query.where(table.c.uuid == target.uuid)
+            previous_values = dict(connection.execute(query).first())
+        else:
+            previous_values = target.get_summary_values(**modified_fields)
+
+        DailySummary = cls.registry.Sale.Order.DailySummary
+        DailySummary.add(connection, sign=-1, **previous_values)
+        DailySummary.add(connection, **target.get_summary_values())
+
+    @classmethod
+    def after_delete_orm_event(cls, mapper, connection, target):
+        cls.registry.Sale.Order.DailySummary.add(
+            connection, sign=-1, **target.get_summary_values())
+
+    @classmethod
+    def update_line_totals(cls, all_orders=False):
+        """Compute ``line_count`` and ``total_quantity`` of the orders
+        stored without them, in one set based UPDATE
+
+        The columns are added with their default value on the existing
+        orders, so the blok update recomputes all the orders once with
+        ``all_orders``
+
+        :param all_orders: recompute every order, not only the ones without
+                           totals
+        :return: number of updated orders
+        """
+        table = cls.__table__
+        line = cls.Line.__table__
+        lines = line.c.order_uuid == table.c.uuid
+        query = table.update()
+        if not all_orders:
+            query = query.where(or_(
+                table.c.line_count.is_(None),
+                table.c.total_quantity.is_(None)))
+
+        query = query.values(
+            line_count=select([func.count()]).where(lines).as_scalar(),
+            total_quantity=select(
+                [func.coalesce(func.sum(line.c.quantity), 0)]
+            ).where(lines).as_scalar())
+        return cls.registry.execute(query).rowcount
+
+    @classmethod
+    def update_tax_breakdown(cls, batch_size=1000, all_orders=False):
+        """Compute ``tax_breakdown`` of the orders stored without it
+
+        The amounts are summed per order and tax rate by one GROUP BY over
+        sale_order_line, read through the column types so the breakdown is
+        formatted as ``compute`` does, and written by batches of orders
+
+        :param batch_size: number of orders updated per statement
+        :param all_orders: recompute every order, not only the ones without
+                           breakdown
+        :return: number of updated orders
+        """
+        Line = cls.Line
+        table = cls.__table__
+        if all_orders:
+            cls.registry.execute(table.update().values(tax_breakdown=null()))
+
+        query = cls.registry.query(
+            Line.order_uuid, Line.unit_tax, func.sum(Line.amount_untaxed),
+            func.sum(Line.amount_tax), func.sum(Line.amount_total))
+        query = query.join(Line.order).filter(cls.tax_breakdown.is_(None))
+        query = query.group_by(Line.order_uuid, Line.unit_tax)
+        query = query.order_by(Line.order_uuid)
+        update = table.update().where(
+            table.c.uuid == bindparam('order_uuid')).values(
+            tax_breakdown=bindparam('order_tax_breakdown'))
+
+        count = 0
+        values = []
+        rows = query.yield_per(batch_size)
+        for order_uuid, order_rows in groupby(rows, key=lambda row: row[0]):
+            breakdown = {}
+            for _, unit_tax, base, tax, total in order_rows:
+                rate = breakdown.setdefault(compute_tax(unit_tax),
+                                            [D(0), D(0), D(0)])
+                rate[0] += base
+                rate[1] += tax
+                rate[2] += total
+
+            values.append({
+                'order_uuid': order_uuid,
+                'order_tax_breakdown': {
+                    str(rate): {'base': str(base), 'tax': str(tax),
+                                'total': str(total)}
+                    for rate, (base, tax, total) in breakdown.items()}})
+            if len(values) == batch_size:
+                cls.registry.execute(update, values)
+                count += len(values)
+                values = []
+
+        if values:
+            cls.registry.execute(update, values)
+            count += len(values)
+
+        # orders without line
+        count += cls.registry.execute(table.update().where(
+            table.c.tax_breakdown.is_(None)).values(
+            tax_breakdown={})).rowcount
+        return count
+
+    def get_tax_breakdown(self):
+        """Return the stored tax breakdown with decimal amounts
+
+        :return: {tax rate: {'base': .., 'tax': .., 'total': ..}}
+        :rtype: dict of decimal
+        """
+        return {D(rate): {key: D(value) for key, value in amounts.items()}
+                for rate, amounts in (self.tax_breakdown or {}).items()}
 
+    @traced('sale.order.compute',
+            attributes=lambda order: {'order_uuid': str(order.uuid)})
+    @timed('sale.order.compute')
     def compute(self):
-        """Compute order total amount"""
+        """Compute order total amount, line count, total quantity and the
+        tax breakdown per tax rate
+
+        The tax breakdown is stored as {tax rate: {'base', 'tax', 'total'}}
+        with amounts serialized as strings
+        """
         amount_untaxed = D(0)
         amount_tax = D(0)
         amount_total = D(0)
+        line_count = 0
+        total_quantity = 0
+        breakdown = {}
 
         for line in self.lines:
             amount_untaxed += line.amount_untaxed
             amount_tax += line.amount_tax
             amount_total += line.amount_total
+            line_count += 1
+            total_quantity += line.quantity
+
+            rate = breakdown.setdefault(compute_tax(line.unit_tax),
+                                        [D(0), D(0), D(0)])
+            rate[0] += line.amount_untaxed
+            rate[1] += line.amount_tax
+            rate[2] += line.amount_total
 
         self.amount_untaxed = amount_untaxed
         self.amount_tax = amount_tax
         self.amount_total = amount_total
+        self.line_count = line_count
+        self.total_quantity = total_quantity
+        self.tax_breakdown = {
+            str(rate): {'base': str(base), 'tax': str(tax),
+                        'total': str(total)}
+            for rate, (base, tax, total) in breakdown.items()}
 
 
 @Declarations.register(Declarations.Model.Sale.Order)
@@ -139,6 +911,17 @@ class Line(Mixin.UuidColumn, Mixin.TrackModel):
     def get_schema_definition(cls, **kwargs):
         return cls.SCHEMA(**kwargs)
 
+    @classmethod
+    def define_table_args(cls):
+        table_args = super(Line, cls).define_table_args()
+        return table_args + (
+            Index('sale_order_line_properties_idx', 'properties',
+                  postgresql_using='gin',
+                  postgresql_ops={'properties': 'jsonb_path_ops'}),
+            Index('sale_order_line_order_properties_hash_idx', 'order_uuid',
+                  'properties_hash'),
+        )
+
     order = Many2One(label="Order",
                      model=Declarations.Model.Sale.Order,
                      nullable=False,
@@ -146,9 +929,11 @@ class Line(Mixin.UuidColumn, Mixin.TrackModel):
 
     item = Many2One(label="Product Item",
                     model=Declarations.Model.Product.Item,
-                    nullable=False)
+                    nullable=False,
+                    index=True)
 
-    properties = Jsonb(label="Item properties", default=dict())
+    properties = DeferredJsonb(label="Item properties", default=dict())
+    properties_hash = String(label="Item and properties hash")
 
     unit_price_untaxed = Decimal(label="Price untaxed", default=D(0))
     unit_price = Decimal(label="Price", default=D(0))
@@ -204,6 +989,27 @@ class Line(Mixin.UuidColumn, Mixin.TrackModel):
                     """unit_price_untaxed can not be greater than unit_price"""
                     )
 
+    @traced('sale.order.line.price_list_item',
+            attributes=lambda line: {
+                'price_list': str(line.order.price_list.uuid),
+                'item': line.item.code},
+            result_attributes=lambda item: {'found': item is not None})
+    @timed('sale.order.line.price_list_item')
+    def get_price_list_item(self):
+        """Return the price list item of the line item in the order price
+        list, None if the item has no price
+        """
+        return self.registry.Sale.PriceList.Item.query().filter_by(
+            price_list=self.order.price_list).filter_by(
+                item=self.item).one_or_none()
+
+    @traced('sale.order.line.compute',
+            attributes=lambda line: {
+                'line_uuid': str(line.uuid),
+                'order_uuid': str(line.order.uuid),
+                'price_list': (line.order.price_list and
+                               str(line.order.price_list.uuid))})
+    @timed('sale.order.line.compute')
     def compute(self):
         """Compute order line total amount
 
@@ -245,9 +1051,7 @@ class Line(Mixin.UuidColumn, Mixin.TrackModel):
             self.unit_tax = compute_tax(self.unit_tax)
         else:
             # compute unit price based on price list
-            price_list_item = self.registry.Sale.PriceList.Item.query(
-                    ).filter_by(price_list=self.order.price_list).filter_by(
-                            item=self.item).one_or_none()
+            price_list_item = self.get_price_list_item()
             if price_list_item:
                 self.unit_price = price_list_item.unit_price
                 self.unit_price_untaxed = price_list_item.unit_price_untaxed
@@ -325,6 +1129,7 @@ class Line(Mixin.UuidColumn, Mixin.TrackModel):
             return
 
     @classmethod
+    @timed('sale.order.line.create')
     def create(cls, order=None, item=None, **kwargs):
         data = kwargs.copy()
 
@@ -352,6 +1157,258 @@ class Line(Mixin.UuidColumn, Mixin.TrackModel):
         return line
 
     @classmethod
+    def get_properties_filter(cls, properties):
+        """Return a containment (``@>``) filter on the line properties, which
+        is served by the jsonb_path_ops GIN index
+
+        :param properties: dict of the wanted properties, nested dicts and
+            lists are matched by containment too
+        :return: SQLAlchemy clause
+        """
+        return cls.properties.contains(properties)
+
+    @classmethod
+    def query_by_properties(cls, properties=None, **kwargs):
+        """Return a query of the lines whose properties contain the given
+        properties
+
+        :Example:
+
+        >>> Line.query_by_properties(lens_type='progressive').all()
+        """
+        properties = dict(properties or {}, **kwargs)
+        return cls.query().filter(cls.get_properties_filter(properties))
+
+    @classmethod
+    def export_columnar(cls, path, date_from=None, date_to=None, states=None,
+                        batch_size=65536, scale=COLUMNAR_AMOUNT_SCALE):
+        """Write the order lines in an Arrow IPC file, which can be memory
+        mapped by analysis tools (``pyarrow.memory_map``)
+
+        The lines are streamed from PostgreSQL and written in record batches
+        of ``batch_size`` rows. Decimal amounts are stored as int64 scaled by
+        ``10 ** scale``, the scale is saved in the schema metadata
+
+        Requires the ``pyarrow`` package (``anyblok_sale[analytics]``)
+
+        :param path: destination file path
+        :param date_from: orders created from this datetime (included)
+        :param date_to: orders created before this datetime (excluded)
+        :param states: order states taken in account, all if None
+        :param batch_size: number of rows per record batch
+        :param scale: number of decimal digits kept for amounts
+        :return: number of exported lines
+        """
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise LineException(
+                "pyarrow is required to export order lines in columnar "
+                "format")
+
+        Order = cls.registry.Sale.Order
+        Item = cls.registry.Product.Item
+        factor = D(10) ** scale
+
+        query = cls.registry.query(
+            Order.uuid.label('order_uuid'), Item.code.label('item_code'),
+            cls.quantity,
+            *[getattr(cls, field).label(field)
+              for field in COLUMNAR_AMOUNT_FIELDS])
+        query = query.select_from(cls).join(cls.order).join(cls.item)
+        if date_from is not None:
+            query = query.filter(Order.create_date >= date_from)
+        if date_to is not None:
+            query = query.filter(Order.create_date < date_to)
+        if states:
+            query = query.filter(Order.state.in_(states))
+
+        fields = [('order_uuid', pa.string()), ('item_code', pa.string()),
+                  ('quantity', pa.int64())]
+        fields.extend((field, pa.int64()) for field in COLUMNAR_AMOUNT_FIELDS)
+        schema = pa.schema(
+            [pa.field(name, type_) for name, type_ in fields],
+            metadata={'amount_scale': str(scale)})
+
+        def scaled(value):
+            if value is None:
+                return None
+            return int((value * factor).to_integral_value())
+
+        def write_batch(writer, rows):
+            arrays = [pa.array([str(row.order_uuid) for row in rows],
+                               type=pa.string()),
+                      pa.array([row.item_code for row in rows],
+                               type=pa.string()),
+                      pa.array([row.quantity for row in rows],
+                               type=pa.int64())]
+            arrays.extend(
+                pa.array([scaled(getattr(row, field)) for row in rows],
+                         type=pa.int64())
+                for field in COLUMNAR_AMOUNT_FIELDS)
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                arrays, schema=schema))
+
+        count = 0
+        writer = pa.RecordBatchFileWriter(path, schema)
+        try:
+            rows = []
+            for row in query.yield_per(batch_size):
+                rows.append(row)
+                if len(rows) == batch_size:
+                    write_batch(writer, rows)
+                    count += len(rows)
+                    rows = []
+
+            if rows:
+                write_batch(writer, rows)
+                count += len(rows)
+        finally:
+            writer.close()
+
+        return count
+
+    @classmethod
+    def top_items(cls, date_from, date_to, order_by='quantity', limit=None,
+                  states=('order',), batch_size=1000):
+        """Rank the product items sold between two dates by quantity or
+        revenue
+
+        The ranking is computed by PostgreSQL in a single aggregate query and
+        the rows are streamed by batches of ``batch_size`` when the returned
+        query is iterated. ``order_by`` is checked when called
+
+        :param date_from: orders created from this datetime (included)
+        :param date_to: orders created before this datetime (excluded)
+        :param order_by: 'quantity' or 'amount_total'
+        :param limit: maximum number of items returned
+        :param states: order states taken in account
+        :return: query of rows (code, quantity, amount_untaxed,
+            amount_total)
+        :exception: LineException
+        """
+        if order_by not in ('quantity', 'amount_total'):
+            raise LineException(
+                "Can not rank items by %r" % order_by)
+
+        Order = cls.registry.Sale.Order
+        Item = cls.registry.Product.Item
+        columns = dict(
+            quantity=func.sum(cls.quantity).label('quantity'),
+            amount_untaxed=func.sum(cls.amount_untaxed).label(
+                'amount_untaxed'),
+            amount_total=func.sum(cls.amount_total).label('amount_total'))
+
+        query = cls.registry.query(
+            Item.code.label('code'), columns['quantity'],
+            columns['amount_untaxed'], columns['amount_total'])
+        query = query.select_from(cls).join(cls.order).join(cls.item)
+        query = query.filter(Order.state.in_(states),
+                             Order.create_date >= date_from,
+                             Order.create_date < date_to)
+        query = query.group_by(
+            *(list(Item.__table__.primary_key.columns) + [Item.code]))
+        query = query.order_by(columns[order_by].desc(), Item.code)
+        if limit:
+            query = query.limit(limit)
+
+        return query.yield_per(batch_size)
+
+    def get_properties_hash(self):
+        return compute_properties_hash(self.item.to_primary_keys(),
+                                       self.properties)
+
+    @classmethod
+    def get_item_foreign_keys(cls):
+        """Return the columns of the line table referencing the product
+        item, with the name of the item primary key they reference
+        """
+        item_table = cls.registry.Product.Item.__table__
+        return [(foreign_key.parent, foreign_key.column.name)
+                for foreign_key in cls.__table__.foreign_keys
+                if foreign_key.column.table is item_table]
+
+    @classmethod
+    def update_properties_hash(cls, batch_size=1000):
+        """Compute the properties hash of the lines inserted without it
+        (lines created before the hash existed or inserted through
+        SQLAlchemy Core)
+
+        The lines are read by keyset pagination on the primary key, so each
+        batch starts from the last updated line instead of scanning the table
+        again for the lines still without hash
+
+        :param batch_size: number of lines updated per statement
+        :return: number of updated lines
+        """
+        table = cls.__table__
+        foreign_keys = cls.get_item_foreign_keys()
+        query = select(
+            [table.c.uuid, table.c.properties] +
+            [column for column, _ in foreign_keys]
+        ).where(table.c.properties_hash.is_(None)).order_by(
+            table.c.uuid).limit(batch_size)
+        update = table.update().where(
+            table.c.uuid == bindparam('line_uuid')).values(
+            properties_hash=bindparam('line_hash'))
+
+        count = 0
+        last = None
+        while True:
+            batch = query if last is None else query.where(
+                table.c.uuid > last)
+            rows = cls.registry.execute(batch).fetchall()
+            if not rows:
+                return count
+
+            last = rows[-1][table.c.uuid]
+            cls.registry.execute(update, [
+                {'line_uuid': row[table.c.uuid],
+                 'line_hash': compute_properties_hash(
+                     {pk: row[column] for column, pk in foreign_keys},
+                     row[table.c.properties])}
+                for row in rows])
+            count += len(rows)
+
+    @classmethod
+    def before_insert_orm_event(cls, mapper, connection, target):
+        target.properties_hash = target.get_properties_hash()
+
+    @classmethod_cache()
+    def has_product_family(cls):
+        """Return True if the product_family blok is installed, the cache
+        lives as long as the registry (reloaded when a blok is installed)
+        """
+        return cls.registry.System.Blok.is_installed('product_family')
+
+    @classmethod_cache()
+    def get_properties_schema(cls, family_key, item_code):
+        """Return the schema instance validating the properties of the lines
+        of an item, or None if its family has no custom schemas. Raise
+        LineException if the family has custom schemas but none for the item
+
+        The schemas are cached per (family, item code) and invalidated by
+        the sale_product_family blok when a family is modified
+
+        :param family_key: primary keys of the family as sorted items
+        :param item_code: lower case code of the item
+        """
+        family = cls.registry.Product.Family.from_primary_keys(
+            **dict(family_key))
+        if family is None or not family.custom_schemas:
+            return None
+
+        custom_schema = family.custom_schemas.get(item_code)
+        if custom_schema is None:
+            raise LineException(
+                "No properties schema for the item %r in the custom schemas "
+                "of the product family %r" % (item_code, dict(family_key)))
+
+        props = custom_schema.get('schema')
+        return props(context={"registry": cls.registry})
+
+    @classmethod
+    @timed('sale.order.line.before_update')
     def before_update_orm_event(cls, mapper, connection, target):
 
         if cls.get_schema_definition:
@@ -362,11 +1419,215 @@ class Line(Mixin.UuidColumn, Mixin.TrackModel):
 
             sch.load(sch.dump(target))
 
-            if (target.properties and
-                cls.registry.System.Blok.is_installed('product_family') and
-                    target.item.template.family.custom_schemas):
-                props = target.item.template.family.custom_schemas.get(
-                            target.item.code.lower()).get('schema')
-                props_sch = props(context={"registry": cls.registry})
-                props_sch.load(target.properties)
+            if target.properties and cls.has_product_family():
+                template = target.item.template
+                family = template and template.family
+                if family is not None:
+                    props_sch = cls.get_properties_schema(
+                        tuple(sorted(family.to_primary_keys().items())),
+                        target.item.code.lower())
+                    if props_sch is not None:
+                        props_sch.load(target.properties)
+
+        target.properties_hash = target.get_properties_hash()
         target.compute()
+
+
+@Declarations.register(Declarations.Model.Sale.Order)
+class DailySummary:
+    """Sale.Order.DailySummary Model
+
+    Order count and amounts per day, channel and state. The orm events of
+    Sale.Order only append rows to Sale.Order.DailySummary.Delta, so the
+    order intake never waits on a lock of a shared summary row. The deltas
+    are summed in the summary by ``rollup``, to call periodically (see
+    anyblok_sale_rebuild_summary) or before reading up to date values, and
+    the summary can be rebuilt for a date range with ``rebuild``
+
+    The day of an order is the date of its ``create_date`` in the timezone
+    given by ``--default-timezone`` (UTC by default), always computed by
+    PostgreSQL so it does not depend on the session TimeZone
+    """
+
+    day = Date(label="Day", primary_key=True)
+    channel = String(label="Sale Channel", primary_key=True)
+    state = String(label="State", primary_key=True)
+
+    order_count = Integer(label="Order count", default=0, nullable=False)
+    amount_untaxed = Decimal(label="Amount Untaxed", default=D(0))
+    amount_tax = Decimal(label="Tax amount", default=D(0))
+    amount_total = Decimal(label="Total", default=D(0))
+
+    def __repr__(self):
+        return "<Sale.Order.DailySummary(day={self.day}," \
+               " channel={self.channel}, state={self.state}," \
+               " order_count={self.order_count}," \
+               " amount_total={self.amount_total})>".format(self=self)
+
+    @classmethod
+    def get_timezone(cls):
+        """Return the name of the timezone of the summary days"""
+        return str(Configuration.get('default_timezone') or 'UTC')
+
+    @classmethod
+    def get_day_expression(cls, create_date):
+        """Return the SQL expression of the summary day of ``create_date``
+
+        :param create_date: timestamp with time zone SQL expression
+        """
+        return func.date(func.timezone(cls.get_timezone(), create_date))
+
+    @classmethod
+    def get_delta_values(cls, create_date=None, channel=None, state=None,
+                         amount_untaxed=None, amount_tax=None,
+                         amount_total=None, sign=1, order_count=1):
+        create_date_type = cls.registry.Sale.Order.__table__.c.create_date.type
+        return dict(
+            day=cls.get_day_expression(cast(
+                literal(create_date, type_=create_date_type),
+                TIMESTAMP(timezone=True))),
+            channel=channel,
+            state=state,
+            order_count=sign * order_count,
+            amount_untaxed=sign * (amount_untaxed or D(0)),
+            amount_tax=sign * (amount_tax or D(0)),
+            amount_total=sign * (amount_total or D(0)))
+
+    @classmethod
+    def add(cls, connection, **values):
+        """Add (or remove with ``sign=-1``) one order, or ``order_count``
+        orders with the sum of their amounts, in the summary
+
+        The delta is appended on the flush connection, so it can be called
+        from orm events. See ``get_delta_values`` for the parameters
+        """
+        connection.execute(cls.Delta.__table__.insert().values(
+            cls.get_delta_values(**values)))
+
+    @classmethod
+    def move(cls, connection, orders, new_state):
+        """Move orders changed to ``new_state`` by a set based UPDATE,
+        with one INSERT of the two deltas of each order, summed by
+        ``rollup``
+
+        :param orders: summary values of the orders before the update,
+                       see ``Sale.Order.get_summary_values``
+        """
+        deltas = []
+        for values in orders:
+            deltas.append(cls.get_delta_values(sign=-1, **values))
+            deltas.append(cls.get_delta_values(
+                **dict(values, state=new_state)))
+
+        if deltas:
+            connection.execute(cls.Delta.__table__.insert().values(deltas))
+
+    @classmethod
+    def rollup(cls):
+        """Sum the pending deltas in the summary and delete them, in one
+        statement::
+
+            WITH deltas AS (DELETE FROM sale_order_dailysummary_delta
+                            RETURNING ...)
+            INSERT INTO sale_order_dailysummary
+            SELECT day, channel, state, sum(...) FROM deltas GROUP BY ...
+            ON CONFLICT (day, channel, state) DO UPDATE ...
+
+        The locks of the summary rows are only held by this short
+        transaction, concurrent rollups skip the deltas already deleted
+        """
+        cls.registry.flush()
+        table = cls.__table__
+        delta = cls.Delta.__table__
+        keys = ('day', 'channel', 'state')
+        fields = ('order_count', 'amount_untaxed', 'amount_tax',
+                  'amount_total')
+        deltas = delta.delete().returning(
+            *[delta.c[field] for field in keys + fields]).cte('deltas')
+        query = insert(table).from_select(
+            keys + fields,
+            select([deltas.c[field] for field in keys] +
+                   [func.sum(deltas.c[field]) for field in fields]
+                   ).group_by(*[deltas.c[field] for field in keys]))
+        query = query.on_conflict_do_update(
+            index_elements=[table.c[field] for field in keys],
+            set_={field: table.c[field] + query.excluded[field]
+                  for field in fields})
+        cls.registry.execute(query)
+        cls.registry.expire_all()
+
+    @classmethod
+    def query_days(cls, date_from, date_to):
+        """Return the query of the summary rows of the days between
+        ``date_from`` and ``date_to`` (included)
+
+        The pending deltas are not rolled up, call ``rollup`` before for up
+        to date values
+        """
+        return cls.query().filter(cls.day >= date_from, cls.day <= date_to)
+
+    @classmethod
+    def rebuild(cls, date_from, date_to):
+        """Recompute the summary from Sale.Order for the days between
+        ``date_from`` and ``date_to`` (included) in one set based query
+
+        sale_order_dailysummary_delta is locked in SHARE ROW EXCLUSIVE mode
+        until the end of the transaction: the orders written concurrently
+        and their deltas wait for the rebuild, so no delta is deleted
+        without its order being counted. Commit soon after the rebuild
+
+        :param date_from: first day
+        :type date_from: date
+        :param date_to: last day
+        :type date_to: date
+        """
+        Order = cls.registry.Sale.Order
+        cls.registry.flush()
+        cls.registry.execute(text(
+            "LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE" %
+            cls.Delta.__table__.name))
+        for model in (cls, cls.Delta):
+            model.query().filter(model.day >= date_from,
+                                 model.day <= date_to).delete(
+                                     synchronize_session=False)
+
+        # A range on create_date can use an index, the day expression can
+        # not: the bounds are the midnights of the summary timezone
+        timezone = cls.get_timezone()
+        day = cls.get_day_expression(Order.create_date)
+        query = Order.query(
+            day, Order.channel, Order.state, func.count(),
+            func.sum(Order.amount_untaxed), func.sum(Order.amount_tax),
+            func.sum(Order.amount_total)
+        ).filter(
+            Order.create_date >= func.timezone(
+                timezone, cast(date_from, TIMESTAMP())),
+            Order.create_date < func.timezone(
+                timezone, cast(date_to + timedelta(days=1), TIMESTAMP()))
+        ).group_by(day, Order.channel, Order.state)
+
+        cls.registry.execute(cls.__table__.insert().from_select(
+            ['day', 'channel', 'state', 'order_count', 'amount_untaxed',
+             'amount_tax', 'amount_total'],
+            query.statement))
+        cls.registry.expire_all()
+
+
+@Declarations.register(Declarations.Model.Sale.Order.DailySummary)
+class Delta:
+    """Sale.Order.DailySummary.Delta Model
+
+    Append only changes of Sale.Order.DailySummary, written by the orm
+    events of Sale.Order and summed in the summary by
+    ``Sale.Order.DailySummary.rollup``
+    """
+
+    id = Integer(label="Identifier", primary_key=True)
+    day = Date(label="Day", nullable=False, index=True)
+    channel = String(label="Sale Channel")
+    state = String(label="State")
+
+    order_count = Integer(label="Order count", default=0, nullable=False)
+    amount_untaxed = Decimal(label="Amount Untaxed", default=D(0))
+    amount_tax = Decimal(label="Tax amount", default=D(0))
+    amount_total = Decimal(label="Total", default=D(0))
@@ -7,12 +7,27 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 # -*- coding: utf-8 -*-
 
+from anyblok.blok import BlokManager
+from anyblok.common import anyblok_column_prefix
 from anyblok.tests.testcase import BlokTestCase
+from anyblok.version import parse_version
 from anyblok_mixins.workflow.exceptions import WorkFlowException
 
+import csv
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from io import StringIO
 from decimal import Decimal as D
+from unittest.mock import patch
 
 from marshmallow.exceptions import ValidationError
+from sqlalchemy import inspect, null, text
+from sqlalchemy.orm.exc import StaleDataError
+
+from anyblok_sale.bloks.sale.model import LineException
+from anyblok_sale.testing import QueryCountTestCase
 
 
 class TestSaleOrderModel(BlokTestCase):
@@ -133,6 +148,22 @@ class TestSaleOrderModel(BlokTestCase):
             ctx.exception.args[0],
             "No rules found to change state from 'order' to 'draft'")
 
+    def test_sale_order_search(self):
+        so1 = self.registry.Sale.Order.create(channel="WEBSITE",
+                                              code="SO-TEST-000001")
+        so2 = self.registry.Sale.Order.create(channel="WEBSITE",
+                                              code="SO-TEST-000002")
+        self.registry.Sale.Order.create(channel="WEBSITE",
+                                        code="SO-OTHER-000003")
+
+        self.assertEqual(self.registry.Sale.Order.search("TEST-000001"),
+                         [so1])
+        self.assertEqual(
+            set(self.registry.Sale.Order.search("test-00000")), {so1, so2})
+        self.assertEqual(
+            len(self.registry.Sale.Order.search("SO-", limit=2)), 2)
+        self.assertEqual(self.registry.Sale.Order.search("SO%TEST"), [])
+
 
 class TestSaleOrderLineModel(BlokTestCase):
     """Test Sale.Order.Line model"""
@@ -217,10 +248,23 @@ class TestSaleOrderLineModel(BlokTestCase):
         self.assertEqual(so.amount_untaxed, D('0'))
         self.assertEqual(so.amount_tax, D('0'))
         self.assertEqual(so.amount_total, D('0'))
+        self.assertEqual(so.line_count, 0)
+        self.assertEqual(so.total_quantity, 0)
         so.compute()
         self.assertEqual(so.amount_untaxed, D('295.31'))
         self.assertEqual(so.amount_tax, D('50.97'))
         self.assertEqual(so.amount_total, D('346.28'))
+        self.assertEqual(so.line_count, 5)
+        self.assertEqual(so.total_quantity, 5)
+
+        breakdown = so.get_tax_breakdown()
+        self.assertEqual(set(breakdown.keys()), {D('0.2'), D('0.021')})
+        self.assertEqual(
+            sum(x['base'] for x in breakdown.values()), so.amount_untaxed)
+        self.assertEqual(
+            sum(x['tax'] for x in breakdown.values()), so.amount_tax)
+        self.assertEqual(
+            sum(x['total'] for x in breakdown.values()), so.amount_total)
 
     def test_compute_sale_order_line_product_price_list(self):
 
@@ -296,6 +340,17 @@ class TestSaleOrderLineModel(BlokTestCase):
         self.assertEqual(so.amount_untaxed, D('166.66'))
         self.assertEqual(so.amount_tax, D('33.34'))
         self.assertEqual(so.amount_total, D('200'))
+        self.assertEqual(so.line_count, 1)
+        self.assertEqual(so.total_quantity, 2)
+        self.assertEqual(so.get_tax_breakdown(), {
+            D('0.2'): {'base': D('166.66'), 'tax': D('33.34'),
+                       'total': D('200')}})
+
+        line.delete()
+        so.compute()
+        self.assertEqual(so.amount_total, D('0'))
+        self.assertEqual(so.line_count, 0)
+        self.assertEqual(so.total_quantity, 0)
 
     def test_compute_sale_order_line_total_quantity_with_pricelist(self):
 
@@ -467,3 +522,601 @@ class TestSaleOrderLineModel(BlokTestCase):
         self.assertEqual(line.amount_discount_percentage, D('0.00'))
         self.assertEqual(line.amount_discount_untaxed, D('0.00'))
         self.assertEqual(line.amount_discount, D('0.00'))
+
+    def test_top_items(self):
+        product1 = self.registry.Product.Item.insert(code="TEST1",
+                                                     name="Test 1")
+        product2 = self.registry.Product.Item.insert(code="TEST2",
+                                                     name="Test 2")
+        for code, state in (("SO-TEST-000001", 'order'),
+                            ("SO-TEST-000002", 'order'),
+                            ("SO-TEST-000003", 'draft')):
+            so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                                 code=code)
+            self.registry.Sale.Order.Line.create(
+                order=so, item=product1, quantity=3, unit_price=10,
+                unit_tax=20)
+            self.registry.Sale.Order.Line.create(
+                order=so, item=product2, quantity=1, unit_price=100,
+                unit_tax=20)
+            if state == 'order':
+                so.state_to('quotation')
+                so.state_to('order')
+
+        date_from = datetime.now() - timedelta(days=1)
+        date_to = datetime.now() + timedelta(days=1)
+        Line = self.registry.Sale.Order.Line
+
+        self.assertEqual(
+            [(x.code, x.quantity, x.amount_total)
+             for x in Line.top_items(date_from, date_to)],
+            [('TEST1', 6, D('60')), ('TEST2', 2, D('200'))])
+        self.assertEqual(
+            [x.code for x in Line.top_items(date_from, date_to,
+                                            order_by='amount_total',
+                                            limit=1)],
+            ['TEST2'])
+        self.assertEqual(
+            list(Line.top_items(date_to, date_to + timedelta(days=1))), [])
+        # checked when called, not when iterated
+        with self.assertRaises(LineException):
+            Line.top_items(date_from, date_to, order_by='code')
+
+    def test_export_orders(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so1 = self.registry.Sale.Order.create(channel="WEBSITE",
+                                              code="SO-TEST-000001")
+        self.registry.Sale.Order.Line.create(
+            order=so1, item=product, quantity=1, unit_price=100, unit_tax=20)
+        self.registry.Sale.Order.Line.create(
+            order=so1, item=product, quantity=2, unit_price=10, unit_tax=20,
+            properties={"color": "red"})
+        self.registry.Sale.Order.create(channel="WEBSITE",
+                                        code="SO-TEST-000002")
+
+        orders = list(self.registry.Sale.Order.iter_export(batch_size=1))
+        self.assertEqual([x['code'] for x in orders],
+                         ["SO-TEST-000001", "SO-TEST-000002"])
+        self.assertEqual([x['quantity'] for x in orders[0]['lines']], [1, 2])
+        self.assertEqual(orders[0]['lines'][1]['properties'],
+                         {"color": "red"})
+        self.assertEqual(orders[1]['lines'], [])
+
+        fileobj = StringIO()
+        self.assertEqual(self.registry.Sale.Order.export_jsonl(fileobj), 2)
+        exported = [json.loads(x) for x in fileobj.getvalue().splitlines()]
+        self.assertEqual([len(x['lines']) for x in exported], [2, 0])
+        self.assertEqual(exported[0]['lines'][0]['item_code'], "TEST")
+
+        fileobj = StringIO()
+        self.assertEqual(
+            self.registry.Sale.Order.export_csv(fileobj,
+                                                states=['draft']), 2)
+        rows = list(csv.reader(StringIO(fileobj.getvalue())))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0][0], 'order_uuid')
+
+    def test_export_columnar(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        for quantity in (1, 2, 3):
+            self.registry.Sale.Order.Line.create(
+                order=so, item=product, quantity=quantity, unit_price=100,
+                unit_tax=20)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lines.arrow')
+            self.assertEqual(
+                self.registry.Sale.Order.Line.export_columnar(
+                    path, batch_size=2), 3)
+            reader = pa.ipc.open_file(pa.memory_map(path))
+            self.assertEqual(reader.num_record_batches, 2)
+            table = reader.read_all()
+
+        self.assertEqual(table.schema.metadata[b'amount_scale'], b'4')
+        self.assertEqual(sorted(table.column('quantity').to_pylist()),
+                         [1, 2, 3])
+        self.assertEqual(set(table.column('unit_price').to_pylist()),
+                         {1000000})
+        self.assertEqual(set(table.column('order_uuid').to_pylist()),
+                         {str(so.uuid)})
+
+    def test_line_properties_deferred(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        self.registry.Sale.Order.Line.create(
+            order=so, item=product, quantity=1, unit_price=100, unit_tax=20,
+            properties={"color": "red"})
+        self.registry.flush()
+        self.registry.expunge_all()
+
+        so = self.registry.Sale.Order.query().options(
+            *self.registry.Sale.Order.get_lines_load_options(
+                with_items=True)).one()
+        line = so.lines[0]
+        state = inspect(line)
+        self.assertIn(anyblok_column_prefix + 'properties', state.unloaded)
+        self.assertNotIn(anyblok_column_prefix + 'item', state.unloaded)
+        self.assertEqual(line.properties, {"color": "red"})
+
+        self.registry.expunge_all()
+        so = self.registry.Sale.Order.query().one()
+        line = so.get_lines_query(with_properties=True).one()
+        self.assertNotIn(anyblok_column_prefix + 'properties',
+                         inspect(line).unloaded)
+
+    def test_query_line_by_properties(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        Line = self.registry.Sale.Order.Line
+        line1 = Line.create(
+            order=so, item=product, quantity=1, unit_price=100, unit_tax=20,
+            properties={"lens_type": "progressive", "sphere": {"od": 1.5}})
+        line2 = Line.create(
+            order=so, item=product, quantity=1, unit_price=100, unit_tax=20,
+            properties={"lens_type": "single", "sphere": {"od": 1.5}})
+        Line.create(order=so, item=product, quantity=1, unit_price=100,
+                    unit_tax=20)
+
+        self.assertEqual(
+            Line.query_by_properties(lens_type='progressive').all(), [line1])
+        self.assertEqual(
+            set(Line.query_by_properties({"sphere": {"od": 1.5}}).all()),
+            {line1, line2})
+        self.assertEqual(
+            Line.query().filter(
+                Line.get_properties_filter({"lens_type": "bifocal"})
+            ).count(), 0)
+
+    def test_preload_lines(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        for quantity in (1, 2):
+            self.registry.Sale.Order.Line.create(
+                order=so, item=product, quantity=quantity, unit_price=100,
+                unit_tax=20)
+        self.registry.flush()
+        self.registry.expunge_all()
+
+        so = self.registry.Sale.Order.query().one()
+        lines = so.preload_lines()
+        self.assertEqual(len(lines), 2)
+        for line in lines:
+            unloaded = inspect(line).unloaded
+            self.assertNotIn(anyblok_column_prefix + 'item', unloaded)
+            self.assertNotIn(anyblok_column_prefix + 'properties', unloaded)
+        self.assertEqual(set(so.lines), set(lines))
+
+    def test_compute_does_not_preload_lines(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        self.registry.Sale.Order.Line.create(
+            order=so, item=product, quantity=1, unit_price=100, unit_tax=20)
+        self.registry.flush()
+        self.registry.expunge_all()
+
+        so = self.registry.Sale.Order.query().one()
+        with patch.object(self.registry.Sale.Order, 'preload_lines') as mock:
+            so.compute()
+
+        mock.assert_not_called()
+        self.assertEqual(so.line_count, 1)
+        self.assertIn(anyblok_column_prefix + 'properties',
+                      inspect(so.lines[0]).unloaded)
+
+    def test_merge_duplicate_lines(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        for quantity, properties in ((1, {'size': 'M'}), (2, {'size': 'M'}),
+                                     (4, {'size': 'L'}), (8, {'size': 'M'})):
+            self.registry.Sale.Order.Line.create(
+                order=so, item=product, quantity=quantity, unit_price=100,
+                unit_tax=20, properties=properties)
+        so.compute()
+        self.assertEqual(so.amount_total, D('1500'))
+        hashes = {x.quantity: x.properties_hash for x in so.lines}
+        self.assertEqual(hashes[1], hashes[2])
+        self.assertNotEqual(hashes[1], hashes[4])
+
+        self.assertEqual(so.merge_duplicate_lines(), 2)
+        self.assertEqual(len(so.lines), 2)
+        self.assertEqual(
+            sorted((x.quantity, x.amount_total) for x in so.lines),
+            [(4, D('400')), (11, D('1100'))])
+        self.assertEqual(so.line_count, 2)
+        self.assertEqual(so.total_quantity, 15)
+        self.assertEqual(so.amount_total, D('1500'))
+        self.assertEqual(so.merge_duplicate_lines(), 0)
+
+    def test_merge_duplicate_lines_without_hash(self):
+        Line = self.registry.Sale.Order.Line
+        product1 = self.registry.Product.Item.insert(code="TEST1",
+                                                     name="Test 1")
+        product2 = self.registry.Product.Item.insert(code="TEST2",
+                                                     name="Test 2")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        for product in (product1, product2, product2):
+            Line.create(order=so, item=product, quantity=1, unit_price=100,
+                        unit_tax=20)
+        so.compute()
+        self.registry.flush()
+        self.registry.execute(Line.__table__.update().values(
+            properties_hash=None))
+        self.registry.expire_all()
+
+        self.assertEqual(so.merge_duplicate_lines(), 0)
+        self.assertEqual(len(so.lines), 3)
+
+        self.assertEqual(Line.update_properties_hash(batch_size=2), 3)
+        self.registry.expire_all()
+        self.assertEqual(Line.query().filter(
+            Line.properties_hash.is_(None)).count(), 0)
+        self.assertEqual(so.merge_duplicate_lines(), 1)
+        self.assertEqual(
+            sorted((x.item.code, x.quantity) for x in so.lines),
+            [("TEST1", 1), ("TEST2", 2)])
+
+    def test_update_line_totals(self):
+        Order = self.registry.Sale.Order
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = Order.create(channel="WEBSITE", code="SO-TEST-000001")
+        empty = Order.create(channel="WEBSITE", code="SO-TEST-000002")
+        for quantity in (2, 3):
+            Order.Line.create(order=so, item=product, quantity=quantity,
+                              unit_price=100, unit_tax=20)
+        so.compute()
+        self.registry.flush()
+        self.registry.execute(Order.__table__.update().values(
+            line_count=None, total_quantity=None))
+
+        self.assertEqual(Order.update_line_totals(), 2)
+        self.registry.expire_all()
+        self.assertEqual((so.line_count, so.total_quantity), (2, 5))
+        self.assertEqual((empty.line_count, empty.total_quantity), (0, 0))
+        self.assertEqual(Order.update_line_totals(), 0)
+
+    def test_update_line_totals_on_upgrade(self):
+        Order = self.registry.Sale.Order
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = Order.create(channel="WEBSITE", code="SO-TEST-000001")
+        for quantity in (2, 3):
+            Order.Line.create(order=so, item=product, quantity=quantity,
+                              unit_price=100, unit_tax=20)
+        so.compute()
+        self.registry.flush()
+        # the columns are filled with their default on the upgraded orders
+        self.registry.execute(Order.__table__.update().values(
+            line_count=0, total_quantity=0))
+        self.assertEqual(Order.update_line_totals(), 0)
+
+        blok = BlokManager.get('sale')(self.registry)
+        blok.update(parse_version('0.1.0'))
+        self.registry.expire_all()
+        self.assertEqual((so.line_count, so.total_quantity), (2, 5))
+
+    def test_update_tax_breakdown(self):
+        Order = self.registry.Sale.Order
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = Order.create(channel="WEBSITE", code="SO-TEST-000001")
+        empty = Order.create(channel="WEBSITE", code="SO-TEST-000002")
+        for unit_tax in (20, 20, 10):
+            Order.Line.create(order=so, item=product, quantity=1,
+                              unit_price=100, unit_tax=unit_tax)
+        so.compute()
+        self.registry.flush()
+        breakdown = so.tax_breakdown
+        self.registry.execute(Order.__table__.update().values(
+            tax_breakdown=null()))
+
+        self.assertEqual(Order.update_tax_breakdown(batch_size=1), 2)
+        self.registry.expire_all()
+        self.assertEqual(so.tax_breakdown, breakdown)
+        self.assertEqual(empty.tax_breakdown, {})
+        self.assertEqual(Order.update_tax_breakdown(), 0)
+
+    def test_update_tax_breakdown_on_upgrade(self):
+        Order = self.registry.Sale.Order
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = Order.create(channel="WEBSITE", code="SO-TEST-000001")
+        Order.Line.create(order=so, item=product, quantity=1,
+                          unit_price=100, unit_tax=20)
+        so.compute()
+        self.registry.flush()
+        breakdown = so.tax_breakdown
+        self.registry.execute(Order.__table__.update().values(
+            tax_breakdown={}))
+        self.assertEqual(Order.update_tax_breakdown(), 0)
+
+        blok = BlokManager.get('sale')(self.registry)
+        blok.update(parse_version('0.1.0'))
+        self.registry.expire_all()
+        self.assertEqual(so.tax_breakdown, breakdown)
+
+    def bump_order_version(self, so):
+        self.registry.execute(
+            text("UPDATE sale_order SET version = version + 1 "
+                 "WHERE uuid = :uuid"), {'uuid': so.uuid})
+
+    def test_sale_order_version_conflict(self):
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        self.registry.flush()
+        self.assertEqual(so.version, 1)
+        so.delivery_method = "POST"
+        self.registry.flush()
+        self.assertEqual(so.version, 2)
+
+        self.bump_order_version(so)
+        so.delivery_method = "UPS"
+        with self.assertRaises(StaleDataError):
+            self.registry.flush()
+
+    def test_sale_order_retry_on_conflict(self):
+        Order = self.registry.Sale.Order
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = Order.create(channel="WEBSITE", code="SO-TEST-000001")
+        self.registry.flush()
+        calls = []
+
+        def add_line(order_uuid):
+            order = Order.query().get(order_uuid)
+            if not calls:
+                # another transaction updates the order meanwhile
+                self.bump_order_version(order)
+            calls.append(order_uuid)
+            Order.Line.create(order=order, item=product, quantity=1,
+                              unit_price=100, unit_tax=20)
+            order.compute()
+            return order
+
+        so = Order.retry_on_conflict(add_line, so.uuid)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(so.line_count, 1)
+        self.assertEqual(so.amount_total, D('100'))
+
+        def conflict():
+            order = Order.query().get(so.uuid)
+            self.bump_order_version(order)
+            order.delivery_method = "UPS"
+
+        with self.assertRaises(StaleDataError):
+            Order.retry_on_conflict(conflict, retries=1)
+
+
+class TestSaleOrderQueryCount(QueryCountTestCase, BlokTestCase):
+    """Query budgets of Sale.Order operations, the number of statements
+    must not grow with the number of lines
+    """
+
+    def create_items(self, size):
+        Item = self.registry.Product.Item
+        start = Item.query().count()
+        return [Item.insert(code="TEST-%d" % i, name="Test")
+                for i in range(start, start + size)]
+
+    def create_order(self, size):
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        for item in self.create_items(size):
+            self.registry.Sale.Order.Line.create(
+                order=so, item=item, quantity=1, unit_price=100, unit_tax=20)
+
+        return so
+
+    def test_create_order_query_count(self):
+        def run(items):
+            so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                                 code="SO-TEST-000001")
+            for item in items:
+                self.registry.Sale.Order.Line.create(
+                    order=so, item=item, quantity=1, unit_price=100,
+                    unit_tax=20)
+            so.compute()
+
+        self.assertQueryCountScale(self.create_items, run, budget=20,
+                                   per_item=3)
+
+    def test_order_compute_query_count(self):
+        self.assertQueryCountScale(self.create_order, lambda so: so.compute(),
+                                   budget=10)
+
+    def test_order_transition_query_count(self):
+        def prepare(size):
+            so = self.create_order(size)
+            so.compute()
+            return so
+
+        def run(so):
+            so.state_to('quotation')
+            so.state_to('order')
+
+        self.assertQueryCountScale(prepare, run, budget=20)
+
+    def test_query_budget(self):
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(0):
+                self.registry.Sale.Order.query().count()
+
+        with self.assertQueryBudget(1) as counter:
+            self.registry.Sale.Order.query().count()
+
+        self.assertEqual(counter.count, 1)
+
+
+class TestSaleOrderDailySummaryModel(BlokTestCase):
+    """Test Sale.Order.DailySummary model"""
+
+    def get_summary(self):
+        Summary = self.registry.Sale.Order.DailySummary
+        Summary.rollup()
+        return {(x.channel, x.state): (x.order_count, x.amount_total)
+                for x in Summary.query().filter(Summary.order_count != 0)}
+
+    def test_daily_summary_incremental(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so1 = self.registry.Sale.Order.create(channel="WEBSITE",
+                                              code="SO-TEST-000001")
+        so2 = self.registry.Sale.Order.create(channel="WEBSITE",
+                                              code="SO-TEST-000002")
+        self.registry.Sale.Order.create(channel="SHOP",
+                                        code="SO-TEST-000003")
+        self.registry.flush()
+        Summary = self.registry.Sale.Order.DailySummary
+        self.assertEqual(Summary.Delta.query().count(), 3)
+        self.assertEqual(self.get_summary(), {
+            ('WEBSITE', 'draft'): (2, D('0')),
+            ('SHOP', 'draft'): (1, D('0')),
+        })
+
+        self.registry.Sale.Order.Line.create(
+            order=so1, item=product, quantity=2, unit_price=100, unit_tax=20)
+        so1.compute()
+        so1.state_to('quotation')
+        self.assertEqual(self.get_summary(), {
+            ('WEBSITE', 'draft'): (1, D('0')),
+            ('WEBSITE', 'quotation'): (1, D('200')),
+            ('SHOP', 'draft'): (1, D('0')),
+        })
+
+        so2.delete()
+        self.assertEqual(self.get_summary(), {
+            ('WEBSITE', 'quotation'): (1, D('200')),
+            ('SHOP', 'draft'): (1, D('0')),
+        })
+        self.assertEqual(Summary.Delta.query().count(), 0)
+        Order = self.registry.Sale.Order
+        day = self.registry.query(
+            Summary.get_day_expression(Order.create_date)).filter(
+            Order.uuid == so1.uuid).scalar()
+        self.assertEqual(
+            {x.state for x in Summary.query_days(day, day).filter(
+                Summary.channel == "WEBSITE", Summary.order_count != 0)},
+            {'quotation'})
+
+    def test_bulk_state_to(self):
+        Order = self.registry.Sale.Order
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        orders = []
+        for i in range(3):
+            so = Order.create(channel="WEBSITE", code="SO-TEST-%06d" % i)
+            Order.Line.create(order=so, item=product, quantity=1,
+                              unit_price=100, unit_tax=20)
+            so.compute()
+            orders.append(so)
+
+        empty = Order.create(channel="WEBSITE", code="SO-TEST-EMPTY")
+        cancelled = Order.create(channel="WEBSITE", code="SO-TEST-CANCEL")
+        cancelled.state_to('cancelled')
+        self.registry.flush()
+        versions = {so.uuid: so.version for so in orders}
+
+        updated, errors = Order.bulk_state_to(
+            orders + [empty, cancelled], 'quotation', batch_size=2)
+        self.assertEqual(set(updated), {so.uuid for so in orders})
+        self.assertEqual(set(errors), {empty.uuid, cancelled.uuid})
+        self.assertIn('lines', errors[empty.uuid])
+        for so in orders:
+            self.assertEqual(so.state, 'quotation')
+            self.assertEqual(so.version, versions[so.uuid] + 1)
+
+        self.assertEqual(self.get_summary(), {
+            ('WEBSITE', 'draft'): (1, D('0')),
+            ('WEBSITE', 'quotation'): (3, D('300')),
+            ('WEBSITE', 'cancelled'): (1, D('0'))})
+
+        with self.assertRaises(WorkFlowException):
+            Order.bulk_state_to(orders, 'unknown')
+
+    def test_expire_quotations(self):
+        Order = self.registry.Sale.Order
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        orders = []
+        for i in range(4):
+            so = Order.create(channel="WEBSITE", code="SO-TEST-%06d" % i)
+            Order.Line.create(order=so, item=product, quantity=1,
+                              unit_price=100, unit_tax=20)
+            so.compute()
+            orders.append(so)
+
+        orders[1].state_to('quotation')
+        orders[2].state_to('quotation')
+        orders[2].state_to('order')
+        self.registry.flush()
+        self.registry.execute(
+            text("UPDATE sale_order SET create_date = create_date - "
+                 "interval '40 days' WHERE code != 'SO-TEST-000003'"))
+        self.registry.Sale.Order.DailySummary.rebuild(
+            (datetime.now() - timedelta(days=41)).date(),
+            datetime.now().date())
+
+        self.assertEqual(Order.expire_quotations(timedelta(days=30),
+                                                 batch_size=1), 1)
+        self.assertEqual(Order.expire_quotations(timedelta(days=30),
+                                                 batch_size=1), 1)
+        self.assertEqual(Order.expire_quotations(timedelta(days=30),
+                                                 batch_size=1), 0)
+        self.assertEqual([so.state for so in orders],
+                         ['cancelled', 'cancelled', 'order', 'draft'])
+        self.assertEqual(self.get_summary(), {
+            ('WEBSITE', 'cancelled'): (2, D('200')),
+            ('WEBSITE', 'order'): (1, D('100')),
+            ('WEBSITE', 'draft'): (1, D('100'))})
+
+    def test_daily_summary_rebuild(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        self.registry.Sale.Order.Line.create(
+            order=so, item=product, quantity=1, unit_price=100, unit_tax=20)
+        so.compute()
+        self.registry.flush()
+        summary = self.get_summary()
+
+        Summary = self.registry.Sale.Order.DailySummary
+        Summary.query().delete()
+        self.assertEqual(self.get_summary(), {})
+
+        # deltas of the rebuilt days are discarded, they are in the orders
+        Summary.add(self.registry.connection(),
+                    **so.get_summary_values(amount_total=D(1)))
+
+        Order = self.registry.Sale.Order
+        day = self.registry.query(
+            Summary.get_day_expression(Order.create_date)).scalar()
+        Summary.rebuild(day, day)
+        self.assertEqual(self.get_summary(), summary)
+        self.assertEqual(summary, {('WEBSITE', 'draft'): (1, D('100'))})
+
+    def test_daily_summary_day_timezone(self):
+        Order = self.registry.Sale.Order
+        Summary = Order.DailySummary
+        so = Order.create(channel="WEBSITE", code="SO-TEST-000001")
+        self.registry.flush()
+        self.registry.execute(
+            text("UPDATE sale_order SET create_date = "
+                 "'2020-01-01 23:00:00+00' WHERE uuid = :uuid"),
+            uuid=so.uuid)
+        # the session is already on January 2nd at UTC+14
+        self.registry.execute(text("SET LOCAL TimeZone = 'Etc/GMT-14'"))
+        self.registry.expire_all()
+
+        day = date(2020, 1, 1)
+        with patch.object(Summary, 'get_timezone', return_value='UTC'):
+            Summary.rebuild(day, day)
+            Summary.add(self.registry.connection(),
+                        **so.get_summary_values())
+
+        self.assertEqual(Summary.query('day').all(), [(day,)])
+        self.assertEqual(Summary.Delta.query('day').all(), [(day,)])
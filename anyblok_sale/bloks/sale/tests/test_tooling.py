@@ -0,0 +1,191 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+
+from anyblok.config import Configuration
+from anyblok.tests.testcase import BlokTestCase
+
+from decimal import Decimal as D
+from unittest.mock import patch
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
+
+from anyblok_sale.benchmark import run_benchmarks
+from anyblok_sale.bloks.sale_base.base import compute_price
+from anyblok_sale.bloks.sale_base.tracing import (
+    InMemoryTracer, register_tracer, unregister_tracer)
+from anyblok_sale.dataset import DatasetGenerator
+from anyblok_sale.load import get_error_name, intake_order, percentile
+
+
+class TestSaleTooling(BlokTestCase):
+    """Test the benchmarks, dataset, load, stats and tracing tools"""
+
+    def setUp(self):
+        super(TestSaleTooling, self).setUp()
+        self.product = self.registry.Product.Item.insert(code="TEST",
+                                                         name="Test")
+
+    def create_order(self, code="SO-TEST-000001", **kwargs):
+        return self.registry.Sale.Order.create(channel="WEBSITE", code=code,
+                                               **kwargs)
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(
+            self.registry, names=['compute_price', 'order_compute_10'])
+        self.assertEqual(results['amount_storage'], 'numeric')
+        self.assertEqual(list(results['benchmarks']),
+                         ['compute_price', 'order_compute_10'])
+        self.assertGreater(
+            results['benchmarks']['order_compute_10']['median'], 0)
+        self.assertEqual(
+            self.registry.Sale.Order.query().filter_by(
+                channel="BENCH").count(), 0)
+
+    def test_run_order_search_benchmark(self):
+        results = run_benchmarks(self.registry, names=['order_search'])
+        self.assertEqual(list(results['benchmarks']), [])
+
+        Configuration.set('benchmark_search_orders', 20)
+        try:
+            results = run_benchmarks(self.registry, names=['order_search'])
+        finally:
+            Configuration.set('benchmark_search_orders', None)
+
+        self.assertEqual(list(results['benchmarks']), ['order_search'])
+        Order = self.registry.Sale.Order
+        self.assertEqual(
+            Order.query().filter(Order.code.like('SO-DATASET-%')).count(), 0)
+
+    def test_dataset_build_order(self):
+        def build(seed):
+            generator = DatasetGenerator(self.registry, seed=seed)
+            prices = [({'id': i}, compute_price(gross=D(10 + i), tax=D('0.2')),
+                       D('0.2'))
+                      for i in range(10)]
+            return generator.build_order(1, (generator.uuid(), prices),
+                                         line_counts=((3, 1),))
+
+        order, lines = build(42)
+        self.assertEqual((order, lines), build(42))
+        self.assertNotEqual(order['uuid'], build(43)[0]['uuid'])
+        self.assertEqual(order['line_count'], 3)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(order['amount_total'],
+                         sum(x['amount_total'] for x in lines))
+        self.assertEqual(order['tax_breakdown']['0.2000']['total'],
+                         str(order['amount_total']))
+
+    def test_load_intake_order(self):
+        items = [self.product] + [
+            self.registry.Product.Item.insert(code="TEST-%d" % i,
+                                              name="Test")
+            for i in range(2)]
+        timings = {'create': [], 'compute': [], 'transition': []}
+        with patch.object(self.registry, 'commit'):
+            intake_order(self.registry, 1, items, 2, timings)
+
+        so = self.registry.Sale.Order.query().filter_by(
+            code="SO-LOAD-1").one()
+        self.assertEqual(so.state, 'order')
+        self.assertEqual(so.total_quantity, 6)
+        self.assertEqual({key: len(value) for key, value in timings.items()},
+                         {'create': 1, 'compute': 1, 'transition': 1})
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        self.assertIsNone(percentile([], 50))
+
+    def test_load_error_name(self):
+        class PgError(Exception):
+            pgcode = '40P01'
+
+        self.assertEqual(get_error_name(StaleDataError()), 'StaleDataError')
+        self.assertEqual(
+            get_error_name(DBAPIError("UPDATE", {}, PgError())),
+            'deadlock_detected')
+        PgError.pgcode = '23505'
+        self.assertEqual(
+            get_error_name(DBAPIError("UPDATE", {}, PgError())),
+            'DBAPIError')
+
+    def test_stats(self):
+        Sale = self.registry.Sale
+        so = self.create_order()
+        self.assertEqual(Sale.get_stats(), {'timers': {}, 'counters': {}})
+
+        Sale.enable_stats()
+        self.addCleanup(Sale.enable_stats, False)
+        self.addCleanup(Sale.reset_stats)
+        Sale.Order.Line.create(order=so, item=self.product, quantity=1,
+                               unit_price=100, unit_tax=20)
+        so.compute()
+        so.state_to('quotation')
+
+        stats = Sale.get_stats()
+        self.assertEqual(stats['timers']['sale.order.line.create']['count'],
+                         1)
+        self.assertGreaterEqual(
+            stats['timers']['sale.order.line.compute']['count'], 1)
+        self.assertEqual(stats['timers']['sale.order.compute']['count'], 1)
+        self.assertIn('sale.order.validator.quotation', stats['timers'])
+        self.assertEqual(stats['counters'],
+                         {'sale.order.transition.quotation': 1})
+        self.assertNotIn('sale.order.create', stats['timers'])
+
+        text = Sale.render_metrics()
+        self.assertIn('sale_operation_duration_seconds_count{'
+                      'operation="sale.order.line.create"} 1', text)
+        self.assertIn('sale_events_total{'
+                      'event="sale.order.transition.quotation"} 1', text)
+        self.assertIn(
+            'sale_cache_hits_total{cache="sale.order.line.properties_schema"}',
+            text)
+
+        Sale.reset_stats()
+        self.assertEqual(Sale.get_stats(), {'timers': {}, 'counters': {}})
+        Sale.enable_stats(False)
+        so.compute()
+        self.assertEqual(Sale.get_stats(), {'timers': {}, 'counters': {}})
+
+    def test_tracing_spans(self):
+        price_list = self.registry.Sale.PriceList.create(code="PL",
+                                                         name="PL")
+        self.registry.Sale.PriceList.Item.create(
+            price_list=price_list, item=self.product, unit_price=100,
+            unit_tax=20)
+
+        tracer = InMemoryTracer()
+        register_tracer(tracer)
+        self.addCleanup(unregister_tracer)
+        so = self.create_order(price_list=price_list)
+        line = self.registry.Sale.Order.Line.create(
+            order=so, item=self.product, quantity=1)
+        so.compute()
+        so.state_to('quotation')
+
+        create, = tracer.get_spans('sale.order.create')
+        self.assertEqual(create.attributes, {
+            'channel': "WEBSITE", 'price_list': str(price_list.uuid),
+            'order_uuid': str(so.uuid)})
+        line_compute = tracer.get_spans('sale.order.line.compute')[0]
+        self.assertEqual(line_compute.attributes['line_uuid'],
+                         str(line.uuid))
+        price, = tracer.get_spans('sale.order.line.price_list_item')[:1]
+        self.assertIs(price.parent, line_compute)
+        self.assertEqual(price.attributes, {
+            'price_list': str(price_list.uuid), 'item': "TEST",
+            'found': True})
+        transition, = tracer.get_spans('sale.order.state_to')
+        self.assertEqual(transition.attributes['new_state'], 'quotation')
+        self.assertIsNone(transition.error)
+        self.assertEqual(len(tracer.get_spans('sale.order.compute')), 1)
+
+        unregister_tracer()
+        tracer.clear()
+        so.compute()
+        self.assertEqual(tracer.get_spans(), [])
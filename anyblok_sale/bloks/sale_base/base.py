@@ -6,11 +6,25 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 # -*- coding: utf-8 -*-
-from decimal import Decimal as D
+from decimal import Decimal as D, ROUND_HALF_UP
 from prices import (
         Money, TaxedMoney, flat_tax, fixed_discount, percentage_discount)
+from sqlalchemy import types
 
 from anyblok import Declarations
+from anyblok.column import Column
+
+from anyblok_sale.bloks.sale_base.metrics import read_metrics, render_metrics
+from anyblok_sale.bloks.sale_base.stats import get_stats
+
+
+# ISO 4217 currencies whose minor unit is not the cent
+CURRENCY_MINOR_UNITS = {
+    'BHD': 3, 'BIF': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'IQD': 3, 'ISK': 0,
+    'JOD': 3, 'JPY': 0, 'KMF': 0, 'KRW': 0, 'KWD': 3, 'LYD': 3, 'OMR': 3,
+    'PYG': 0, 'RWF': 0, 'TND': 3, 'UGX': 0, 'UYI': 0, 'VND': 0, 'VUV': 0,
+    'XAF': 0, 'XOF': 0, 'XPF': 0,
+}
 
 
 def compute_tax(tax=0):
@@ -181,6 +195,153 @@ def compute_discount(price=None, tax=0, discount_amount=0, discount_percent=0,
                                  keep_gross=False)
 
 
+def invalidate_cache_from_orm_event(connection, model, method):
+    """Invalidate a cached method of a model from an orm event
+
+    ``System.Cache.invalidate`` can not be used during a flush because it
+    inserts the invalidation through the session. The invalidation is
+    written on the flush connection instead (other processes see it as any
+    other invalidation) and the cache of the current registry is cleared.
+
+    :param connection: connection given to the orm event
+    :param model: model class owning the cached method
+    :param method: name of the cached method
+    """
+    registry = model.registry
+    connection.execute(registry.System.Cache.__table__.insert().values(
+        registry_name=model.__registry_name__, method=method))
+    for cache in registry.caches[model.__registry_name__][method]:
+        cache.cache_clear()
+
+
+def get_minor_unit_scale(currency='EUR'):
+    """Number of decimal digits of the minor unit of a currency
+
+    :param currency: Currency (3 character code)
+    :type currency: string
+    :return: 2 unless the currency is in ``CURRENCY_MINOR_UNITS``
+    :rtype: int
+    """
+    return CURRENCY_MINOR_UNITS.get(currency.upper(), 2)
+
+
+def to_minor_units(amount, currency='EUR'):
+    """Convert an amount to an integer number of minor units
+
+    :Example:
+
+    >>> to_minor_units(D('12.345'), currency='EUR')
+    >>> 1235
+    """
+    scale = get_minor_unit_scale(currency)
+    return int((D(amount) * 10 ** scale).quantize(
+        D(1), rounding=ROUND_HALF_UP))
+
+
+def from_minor_units(value, currency='EUR'):
+    """Convert an integer number of minor units to a decimal amount
+
+    :Example:
+
+    >>> from_minor_units(1235, currency='EUR')
+    >>> Decimal('12.35')
+    """
+    return D(value).scaleb(-get_minor_unit_scale(currency))
+
+
+class MinorUnitsType(types.TypeDecorator):
+    """Store decimal amounts as BIGINT minor units of a currency"""
+
+    impl = types.BigInteger
+
+    def __init__(self, currency='EUR', *args, **kwargs):
+        super(MinorUnitsType, self).__init__(*args, **kwargs)
+        self.currency = currency
+
+    @property
+    def python_type(self):
+        return D
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return to_minor_units(value, self.currency)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return from_minor_units(value, self.currency)
+
+    def copy(self, **kwargs):
+        return MinorUnitsType(self.currency)
+
+
+class MinorUnits(Column):
+    """Decimal amount column stored as BIGINT minor units
+
+    ::
+
+        @Declarations.register(Declarations.Model)
+        class Test:
+
+            amount = MinorUnits(currency='EUR', default=D(0))
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.currency = kwargs.pop('currency', 'EUR')
+        self.sqlalchemy_type = MinorUnitsType(self.currency)
+        super(MinorUnits, self).__init__(*args, **kwargs)
+
+
 @Declarations.register(Declarations.Model)
 class Sale:
     """Namespace for Sale related models"""
+
+    @classmethod
+    def enable_stats(cls, enabled=True, directory=None):
+        """Enable (or disable) the timers and counters of the sale hot
+        paths for this registry
+
+        :param directory: directory shared by the processes to aggregate
+                          their metrics, None to export only the metrics
+                          of this process
+        """
+        stats = get_stats(cls.registry)
+        stats.enabled = enabled
+        stats.directory = directory
+        stats.get_caches = cls.get_metrics_caches
+
+    @classmethod
+    def reset_stats(cls):
+        """Reset the timers and counters, e.g. at the start of a request"""
+        get_stats(cls.registry).reset()
+
+    @classmethod
+    def get_stats(cls):
+        """Return the timers and counters collected since the last reset
+
+        :return: {'timers': {name: {'count', 'total', 'min', 'max',
+                  'mean'}}, 'counters': {name: value}}, durations in seconds
+        """
+        return get_stats(cls.registry).to_dict()
+
+    @classmethod
+    def get_metrics_caches(cls):
+        """Return the caches exported with the metrics, overridden by the
+        bloks owning caches
+
+        :return: {name: cache_info()}
+        """
+        return {}
+
+    @classmethod
+    def render_metrics(cls):
+        """Render the metrics in the Prometheus text exposition format,
+        summed over the processes sharing the metrics directory
+        """
+        stats = get_stats(cls.registry)
+        if stats.directory is None:
+            return render_metrics(stats.get_metrics())
+
+        stats.flush()
+        return render_metrics(read_metrics(stats.directory))
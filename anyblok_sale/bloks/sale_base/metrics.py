@@ -0,0 +1,124 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+"""Prometheus text exposition of the sale statistics
+
+Each process writes its cumulative histograms, counters and cache
+statistics in its own JSON file of a shared directory. The exporter sums
+the files of all the processes, so any web process hosting the registry can
+serve the metrics of the whole deployment. The directory should be emptied
+with ``clear_metrics`` when the deployment starts.
+"""
+import json
+import os
+from glob import glob
+from tempfile import NamedTemporaryFile
+
+# upper bounds in seconds of the latency histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+FILE_PREFIX = 'sale_metrics_'
+
+
+def get_metrics_path(directory, pid=None):
+    return os.path.join(directory, '%s%d.json' % (FILE_PREFIX,
+                                                  pid or os.getpid()))
+
+
+def write_metrics(directory, metrics):
+    """Atomically write the metrics of the current process"""
+    with NamedTemporaryFile('w', dir=directory, prefix='.' + FILE_PREFIX,
+                            delete=False) as metrics_file:
+        json.dump(metrics, metrics_file)
+
+    os.replace(metrics_file.name, get_metrics_path(directory))
+
+
+def clear_metrics(directory):
+    """Remove the metrics files of all the processes"""
+    for path in glob(os.path.join(directory, FILE_PREFIX + '*.json')):
+        os.remove(path)
+
+
+def merge_metrics(metrics, other):
+    """Add the values of other in metrics"""
+    for name, (counts, total) in other.get('histograms', {}).items():
+        histogram = metrics['histograms'].setdefault(
+            name, [[0] * (len(BUCKETS) + 1), 0.0])
+        histogram[0] = [x + y for x, y in zip(histogram[0], counts)]
+        histogram[1] += total
+
+    for name, value in other.get('totals', {}).items():
+        metrics['totals'][name] = metrics['totals'].get(name, 0) + value
+
+    for name, info in other.get('caches', {}).items():
+        cache = metrics['caches'].setdefault(name, {'hits': 0, 'misses': 0})
+        cache['hits'] += info['hits']
+        cache['misses'] += info['misses']
+
+    return metrics
+
+
+def read_metrics(directory):
+    """Return the sum of the metrics files of all the processes"""
+    metrics = {'histograms': {}, 'totals': {}, 'caches': {}}
+    for path in sorted(glob(os.path.join(directory, FILE_PREFIX + '*.json'))):
+        try:
+            with open(path) as metrics_file:
+                merge_metrics(metrics, json.load(metrics_file))
+        except (OSError, ValueError):
+            # removed or replaced while listed
+            continue
+
+    return metrics
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def render_metrics(metrics, prefix='sale'):
+    """Render metrics in the Prometheus text exposition format
+
+    :param metrics: {'histograms': {operation: [bucket counts, sum]},
+                     'totals': {event: value},
+                     'caches': {cache: {'hits': .., 'misses': ..}}}
+    :return: text/plain; version=0.0.4 content
+    """
+    lines = []
+    name = prefix + '_operation_duration_seconds'
+    lines.append('# HELP %s Duration of the sale operations' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for operation, (counts, total) in sorted(metrics['histograms'].items()):
+        label = 'operation="%s"' % escape_label(operation)
+        cumulated = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), counts):
+            cumulated += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (
+                name, label, bound, cumulated))
+
+        lines.append('%s_sum{%s} %r' % (name, label, float(total)))
+        lines.append('%s_count{%s} %d' % (name, label, cumulated))
+
+    name = prefix + '_events_total'
+    lines.append('# HELP %s Number of sale events' % name)
+    lines.append('# TYPE %s counter' % name)
+    for event, value in sorted(metrics['totals'].items()):
+        lines.append('%s{event="%s"} %d' % (name, escape_label(event), value))
+
+    for key, help_ in (('hits', 'Hits'), ('misses', 'Misses')):
+        name = '%s_cache_%s_total' % (prefix, key)
+        lines.append('# HELP %s %s of the sale caches' % (name, help_))
+        lines.append('# TYPE %s counter' % name)
+        for cache, info in sorted(metrics['caches'].items()):
+            lines.append('%s{cache="%s"} %d' % (
+                name, escape_label(cache), info[key]))
+
+    return '\n'.join(lines) + '\n'
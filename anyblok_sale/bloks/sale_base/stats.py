@@ -0,0 +1,177 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+"""Timers and counters of the sale hot paths
+
+The statistics are kept per registry and disabled by default, a disabled
+timer costs one dict lookup. They are driven through the ``Model.Sale``
+namespace::
+
+    registry.Sale.enable_stats()
+    registry.Sale.reset_stats()
+    ...
+    registry.Sale.get_stats()
+"""
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+from anyblok_sale.bloks.sale_base.metrics import BUCKETS, write_metrics
+
+# seconds between two writes of the metrics file of the process
+FLUSH_INTERVAL = 1.0
+
+
+class Stats:
+    """Timers and counters of one registry
+
+    ``timers`` and ``counters`` are reset per request, ``histograms`` and
+    ``totals`` are cumulative and exported as metrics. When ``directory``
+    is set, the cumulative values are written in a file of this directory
+    at most every ``FLUSH_INTERVAL`` seconds, to be aggregated with the
+    other processes
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.get_caches = None
+        self.next_flush = 0
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+        self.totals = {}
+
+    def add(self, name, duration):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = [
+                [0] * (len(BUCKETS) + 1), 0.0]
+        histogram[0][bisect_left(BUCKETS, duration)] += 1
+        histogram[1] += duration
+
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, duration, duration, duration]
+        else:
+            timer[0] += 1
+            timer[1] += duration
+            if duration < timer[2]:
+                timer[2] = duration
+            if duration > timer[3]:
+                timer[3] = duration
+
+        self.flush_if_needed()
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.totals[name] = self.totals.get(name, 0) + value
+        self.flush_if_needed()
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+
+    def get_metrics(self):
+        """Return the cumulative values exported as metrics"""
+        return {
+            'histograms': self.histograms,
+            'totals': self.totals,
+            'caches': {
+                name: {'hits': info.hits, 'misses': info.misses}
+                for name, info in (
+                    self.get_caches() if self.get_caches else {}).items()},
+        }
+
+    def flush(self):
+        if self.directory is not None:
+            write_metrics(self.directory, self.get_metrics())
+            self.next_flush = perf_counter() + FLUSH_INTERVAL
+
+    def flush_if_needed(self):
+        if self.directory is not None and perf_counter() >= self.next_flush:
+            self.flush()
+
+    def to_dict(self):
+        return {
+            'timers': {
+                name: {'count': count, 'total': total, 'min': min_,
+                       'max': max_, 'mean': total / count}
+                for name, (count, total, min_, max_) in self.timers.items()},
+            'counters': dict(self.counters),
+        }
+
+
+REGISTRY_STATS = {}
+
+
+def get_stats(registry):
+    """Return the statistics of a registry"""
+    stats = REGISTRY_STATS.get(registry.db_name)
+    if stats is None:
+        stats = REGISTRY_STATS[registry.db_name] = Stats()
+
+    return stats
+
+
+def get_enabled_stats(registry):
+    """Return the statistics of a registry if they are enabled else None"""
+    stats = REGISTRY_STATS.get(registry.db_name)
+    if stats is not None and stats.enabled:
+        return stats
+
+    return None
+
+
+def timed(name):
+    """Time the calls of a method (or classmethod, the decorator must be
+    under ``@classmethod``) in the statistics of its registry
+    """
+    def wrapper(method):
+        @wraps(method)
+        def wrapped(self, *args, **kwargs):
+            stats = get_enabled_stats(self.registry)
+            if stats is None:
+                return method(self, *args, **kwargs)
+
+            start = perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                stats.add(name, perf_counter() - start)
+
+        return wrapped
+
+    return wrapper
+
+
+def incr(registry, name, value=1):
+    """Increment a counter in the statistics of a registry if enabled"""
+    stats = get_enabled_stats(registry)
+    if stats is not None:
+        stats.incr(name, value)
+
+
+class TimedValidator:
+    """Time a workflow validator in the statistics of the model registry"""
+
+    def __init__(self, model, name, validator):
+        self.model = model
+        self.name = name
+        self.validator = validator
+
+    def __call__(self, *args, **kwargs):
+        stats = get_enabled_stats(self.model.registry)
+        if stats is None:
+            return self.validator(*args, **kwargs)
+
+        start = perf_counter()
+        try:
+            return self.validator(*args, **kwargs)
+        finally:
+            stats.add(self.name, perf_counter() - start)
@@ -9,10 +9,16 @@
 
 from anyblok.tests.testcase import BlokTestCase
 
+import os
+import tempfile
 from decimal import Decimal as D
 
 from anyblok_sale.bloks.sale_base.base import (
-            compute_tax, compute_price, compute_discount)
+            compute_tax, compute_price, compute_discount, to_minor_units,
+            from_minor_units)
+from anyblok_sale.bloks.sale_base.metrics import (
+            clear_metrics, get_metrics_path, read_metrics, render_metrics,
+            write_metrics)
 
 
 class TestSaleBase(BlokTestCase):
@@ -257,3 +263,51 @@ class TestSaleBase(BlokTestCase):
         self.assertEqual(discount.gross.amount, D('110'))
         self.assertEqual(discount.tax.amount, D('18.33'))
         self.assertEqual(discount.currency, 'EUR')
+
+    def test_minor_units(self):
+        self.assertEqual(to_minor_units(D('12.345')), 1235)
+        self.assertEqual(to_minor_units(D('-0.5'), currency='EUR'), -50)
+        self.assertEqual(to_minor_units(D('1200.4'), currency='JPY'), 1200)
+        self.assertEqual(to_minor_units(D('1.2345'), currency='KWD'), 1235)
+        self.assertEqual(from_minor_units(1235), D('12.35'))
+        self.assertEqual(from_minor_units(1200, currency='jpy'), D('1200'))
+        self.assertEqual(from_minor_units(1235, currency='KWD'), D('1.235'))
+
+    def test_render_metrics_from_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(clear_metrics, directory)
+        counts = [0] * 14
+        counts[2] = 1
+        write_metrics(directory, {
+            'histograms': {'sale.order.create': [counts, 0.004]},
+            'totals': {'sale.order.transition.order': 2},
+            'caches': {'price': {'hits': 3, 'misses': 1}}})
+        os.rename(get_metrics_path(directory),
+                  get_metrics_path(directory, pid=1))
+        counts = [0] * 14
+        counts[13] = 1
+        write_metrics(directory, {
+            'histograms': {'sale.order.create': [counts, 20.0]},
+            'totals': {'sale.order.transition.order': 1},
+            'caches': {}})
+
+        text = render_metrics(read_metrics(directory))
+        self.assertIn('# TYPE sale_operation_duration_seconds histogram',
+                      text)
+        self.assertIn('sale_operation_duration_seconds_bucket{'
+                      'operation="sale.order.create",le="0.001"} 0', text)
+        self.assertIn('sale_operation_duration_seconds_bucket{'
+                      'operation="sale.order.create",le="0.005"} 1', text)
+        self.assertIn('sale_operation_duration_seconds_bucket{'
+                      'operation="sale.order.create",le="+Inf"} 2', text)
+        self.assertIn('sale_operation_duration_seconds_count{'
+                      'operation="sale.order.create"} 2', text)
+        self.assertIn('sale_events_total{'
+                      'event="sale.order.transition.order"} 3', text)
+        self.assertIn('sale_cache_hits_total{cache="price"} 3', text)
+        self.assertIn('sale_cache_misses_total{cache="price"} 1', text)
+
+        clear_metrics(directory)
+        self.assertEqual(read_metrics(directory),
+                         {'histograms': {}, 'totals': {}, 'caches': {}})
@@ -0,0 +1,166 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+"""Tracing spans around the sale operations
+
+Spans are no-ops until a tracer is registered. A tracer is any object with
+a ``start_span(name, attributes)`` method returning a span with
+``set_attribute(key, value)`` and ``end(error=None)`` methods, an adapter
+to an external tracing library only has to implement them::
+
+    register_tracer(InMemoryTracer())
+"""
+from functools import wraps
+from time import perf_counter
+
+
+TRACER = None
+
+
+def register_tracer(tracer):
+    """Register the tracer receiving the sale spans of this process"""
+    global TRACER
+    TRACER = tracer
+
+
+def unregister_tracer():
+    global TRACER
+    TRACER = None
+
+
+def get_tracer():
+    return TRACER
+
+
+class NoopSpan:
+
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class SpanContext:
+    """Context manager ending a span, with the error if any"""
+
+    def __init__(self, span):
+        self.span = span
+
+    def set_attribute(self, key, value):
+        self.span.set_attribute(key, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.end(error=exc_value)
+        return False
+
+
+def span(name, **attributes):
+    """Open a span around a block
+
+    ::
+
+        with span('sale.order.compute', order_uuid=order.uuid) as sp:
+            ...
+            sp.set_attribute('line_count', count)
+    """
+    if TRACER is None:
+        return NOOP_SPAN
+
+    return SpanContext(TRACER.start_span(name, attributes))
+
+
+def traced(name, attributes=None, result_attributes=None):
+    """Open a span around the calls of a method (or classmethod, the
+    decorator must be under ``@classmethod``)
+
+    :param attributes: callable taking the arguments of the method and
+                       returning the attributes of the span
+    :param result_attributes: callable taking the result of the method and
+                              returning attributes added to the span
+    """
+    def wrapper(method):
+        @wraps(method)
+        def wrapped(*args, **kwargs):
+            if TRACER is None:
+                return method(*args, **kwargs)
+
+            with span(name, **(attributes(*args, **kwargs)
+                               if attributes else {})) as sp:
+                result = method(*args, **kwargs)
+                if result_attributes:
+                    for key, value in result_attributes(result).items():
+                        sp.set_attribute(key, value)
+
+                return result
+
+        return wrapped
+
+    return wrapper
+
+
+class InMemorySpan:
+
+    def __init__(self, tracer, name, attributes, parent):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = dict(attributes)
+        self.parent = parent
+        self.error = None
+        self.start = perf_counter()
+        self.duration = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        self.duration = perf_counter() - self.start
+        self.error = error
+        self.tracer.end_span(self)
+
+    def __repr__(self):
+        return "<InMemorySpan(name={self.name}, " \
+               "attributes={self.attributes})>".format(self=self)
+
+
+class InMemoryTracer:
+    """Tracer keeping the spans in memory, used by the tests"""
+
+    def __init__(self):
+        self.spans = []
+        self.stack = []
+
+    def start_span(self, name, attributes):
+        span = InMemorySpan(self, name, attributes,
+                            self.stack[-1] if self.stack else None)
+        self.stack.append(span)
+        return span
+
+    def end_span(self, span):
+        if span in self.stack:
+            self.stack.remove(span)
+
+        self.spans.append(span)
+
+    def get_spans(self, name=None):
+        """Return the ended spans, of a name if given"""
+        return [span for span in self.spans
+                if name is None or span.name == name]
+
+    def clear(self):
+        self.spans = []
+        self.stack = []
@@ -0,0 +1,102 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+
+from anyblok.blok import Blok
+from logging import getLogger
+from sqlalchemy import text
+
+from anyblok_sale.bloks.sale_base.base import get_minor_unit_scale
+logger = getLogger(__name__)
+
+
+class SaleMinorUnitsBlok(Blok):
+    """SaleMinorUnits blok
+    Store the sale amounts as integer minor units of the currency (cents)
+    instead of numeric columns. The models still expose decimal amounts
+    """
+    version = "0.1.0"
+    author = "Franck BRET"
+
+    required = ['sale']
+
+    def get_column_type(self, table, column):
+        return self.registry.execute(
+            text("SELECT data_type FROM information_schema.columns "
+                 "WHERE table_name = :table "
+                 "AND column_name = :column"),
+            {'table': table, 'column': column}).scalar()
+
+    def check_currency(self):
+        """Check that ``--sale-currency`` is the currency the amounts are
+        stored with, the first currency is recorded in System.Parameter
+
+        :exception: CurrencyException
+        """
+        from .model import CURRENCY, CURRENCY_PARAMETER, CurrencyException
+        Parameter = self.registry.System.Parameter
+        if not Parameter.is_exist(CURRENCY_PARAMETER):
+            Parameter.set(CURRENCY_PARAMETER, CURRENCY)
+            return
+
+        currency = Parameter.get(CURRENCY_PARAMETER)
+        if currency != CURRENCY:
+            raise CurrencyException(
+                "The amounts are stored in %s minor units, --sale-currency "
+                "can not be changed to %s" % (currency, CURRENCY))
+
+    def update(self, latest_version):
+        self.check_currency()
+
+    def load(self):
+        self.check_currency()
+
+    def pre_migration(self, latest_version):
+        """Convert the existing numeric amounts to minor units before the
+        columns are migrated to BIGINT
+        """
+        from .model import MINOR_UNITS_COLUMNS, CURRENCY
+        factor = 10 ** get_minor_unit_scale(CURRENCY)
+        for table, columns in MINOR_UNITS_COLUMNS.items():
+            for column in columns:
+                if self.get_column_type(table, column) != 'numeric':
+                    continue
+
+                logger.info("Convert %s.%s to minor units", table, column)
+                self.registry.execute(
+                    "ALTER TABLE {table} ALTER COLUMN {column} TYPE bigint "
+                    "USING round({column} * {factor})".format(
+                        table=table, column=column, factor=factor))
+
+    def uninstall(self):
+        """Convert the minor units back to numeric amounts, before the
+        registry is reloaded with the numeric columns of the sale bloks
+        """
+        from .model import MINOR_UNITS_COLUMNS, CURRENCY_PARAMETER
+        self.check_currency()
+        currency = self.registry.System.Parameter.pop(CURRENCY_PARAMETER)
+        factor = 10 ** get_minor_unit_scale(currency)
+        for table, columns in MINOR_UNITS_COLUMNS.items():
+            for column in columns:
+                if self.get_column_type(table, column) != 'bigint':
+                    continue
+
+                logger.info("Convert %s.%s to numeric", table, column)
+                self.registry.execute(
+                    "ALTER TABLE {table} ALTER COLUMN {column} TYPE numeric "
+                    "USING {column}::numeric / {factor}".format(
+                        table=table, column=column, factor=factor))
+
+    @classmethod
+    def import_declaration_module(cls):
+        from . import model # noqa
+
+    @classmethod
+    def reload_declaration_module(cls, reload):
+        from . import model
+        reload(model)
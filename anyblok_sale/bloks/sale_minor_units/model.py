@@ -0,0 +1,103 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+from decimal import Decimal as D
+
+from anyblok import Declarations
+from anyblok.config import Configuration
+
+from anyblok_sale.bloks.sale_base.base import MinorUnits
+
+
+# read when the declarations are imported (or reloaded) by the registry
+CURRENCY = Configuration.get('sale_currency') or 'EUR'
+
+# System.Parameter key of the currency the amounts are stored with
+CURRENCY_PARAMETER = 'sale_minor_units.currency'
+
+
+class CurrencyException(Exception):
+    """Raised when --sale-currency differs from the currency of the amounts
+    stored as minor units"""
+
+
+MINOR_UNITS_COLUMNS = {
+    'sale_pricelist_item': ('unit_price_untaxed', 'unit_price'),
+    'sale_order': ('amount_untaxed', 'amount_tax', 'amount_total'),
+    'sale_order_line': ('unit_price_untaxed', 'unit_price', 'amount_untaxed',
+                        'amount_tax', 'amount_total',
+                        'amount_discount_untaxed', 'amount_discount'),
+    'sale_order_dailysummary': ('amount_untaxed', 'amount_tax',
+                                'amount_total'),
+    'sale_order_dailysummary_delta': ('amount_untaxed', 'amount_tax',
+                                      'amount_total'),
+}
+
+
+@Declarations.register(Declarations.Model.Sale.PriceList)
+class Item:
+    """Overrides Sale.PriceList.Item prices as minor units"""
+
+    unit_price_untaxed = MinorUnits(label="Price untaxed", currency=CURRENCY,
+                                    default=D(0))
+    unit_price = MinorUnits(label="Price", currency=CURRENCY, default=D(0))
+
+
+@Declarations.register(Declarations.Model.Sale)
+class Order:
+    """Overrides Sale.Order amounts as minor units"""
+
+    amount_untaxed = MinorUnits(label="Amount Untaxed", currency=CURRENCY,
+                                default=D(0))
+    amount_tax = MinorUnits(label="Tax amount", currency=CURRENCY,
+                            default=D(0))
+    amount_total = MinorUnits(label="Total", currency=CURRENCY, default=D(0))
+
+
+@Declarations.register(Declarations.Model.Sale.Order)
+class Line:
+    """Overrides Sale.Order.Line prices and amounts as minor units, the tax
+    and the discount percentages stay decimals
+    """
+
+    unit_price_untaxed = MinorUnits(label="Price untaxed", currency=CURRENCY,
+                                    default=D(0))
+    unit_price = MinorUnits(label="Price", currency=CURRENCY, default=D(0))
+
+    amount_untaxed = MinorUnits(label="Amount untaxed", currency=CURRENCY,
+                                default=D(0))
+    amount_tax = MinorUnits(label="Tax amount", currency=CURRENCY,
+                            default=D(0))
+    amount_total = MinorUnits(label="Total", currency=CURRENCY, default=D(0))
+
+    amount_discount_untaxed = MinorUnits(label="Amount discount untaxed",
+                                         currency=CURRENCY, default=D(0))
+    amount_discount = MinorUnits(label="Amount discount", currency=CURRENCY,
+                                 default=D(0))
+
+
+@Declarations.register(Declarations.Model.Sale.Order)
+class DailySummary:
+    """Overrides Sale.Order.DailySummary amounts as minor units"""
+
+    amount_untaxed = MinorUnits(label="Amount Untaxed", currency=CURRENCY,
+                                default=D(0))
+    amount_tax = MinorUnits(label="Tax amount", currency=CURRENCY,
+                            default=D(0))
+    amount_total = MinorUnits(label="Total", currency=CURRENCY, default=D(0))
+
+
+@Declarations.register(Declarations.Model.Sale.Order.DailySummary)
+class Delta:
+    """Overrides Sale.Order.DailySummary.Delta amounts as minor units"""
+
+    amount_untaxed = MinorUnits(label="Amount Untaxed", currency=CURRENCY,
+                                default=D(0))
+    amount_tax = MinorUnits(label="Tax amount", currency=CURRENCY,
+                            default=D(0))
+    amount_total = MinorUnits(label="Total", currency=CURRENCY, default=D(0))
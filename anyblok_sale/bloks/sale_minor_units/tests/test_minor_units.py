@@ -0,0 +1,91 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+
+from anyblok.blok import BlokManager
+from anyblok.tests.testcase import BlokTestCase
+from anyblok.version import parse_version
+
+from decimal import Decimal as D
+from unittest.mock import patch
+from sqlalchemy import func, select
+
+from anyblok_sale.bloks.sale_minor_units.model import (
+    CURRENCY, CURRENCY_PARAMETER, CurrencyException)
+
+
+class TestMinorUnitsModel(BlokTestCase):
+    """Test amounts stored as minor units"""
+
+    def test_sale_order_amounts_as_minor_units(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        line = self.registry.Sale.Order.Line.create(
+            order=so, item=product, quantity=3, unit_price=D('33.33'),
+            unit_tax=0)
+        so.compute()
+        self.registry.flush()
+
+        self.assertEqual(line.amount_total, D('99.99'))
+        self.assertEqual(so.amount_total, D('99.99'))
+
+        Line = self.registry.Sale.Order.Line
+        table = Line.__table__
+        self.assertEqual(
+            self.registry.execute(
+                select([table.c.amount_total]).where(
+                    table.c.uuid == line.uuid)).scalar(), D('99.99'))
+        self.assertEqual(
+            self.registry.execute(
+                "SELECT amount_total FROM sale_order_line").scalar(), 9999)
+        self.assertEqual(
+            self.registry.query(func.sum(Line.amount_total)).scalar(),
+            D('99.99'))
+        self.assertEqual(
+            Line.query().filter(Line.amount_total == D('99.99')).count(), 1)
+
+    def get_stored_amount(self):
+        return self.registry.execute(
+            "SELECT amount_total FROM sale_order_line").scalar()
+
+    def test_uninstall_and_migrate_amounts(self):
+        product = self.registry.Product.Item.insert(code="TEST", name="Test")
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        self.registry.Sale.Order.Line.create(
+            order=so, item=product, quantity=3, unit_price=D('33.33'),
+            unit_tax=0)
+        self.registry.flush()
+        blok = BlokManager.get('sale_minor_units')(self.registry)
+
+        blok.uninstall()
+        self.assertEqual(
+            blok.get_column_type('sale_order_line', 'amount_total'),
+            'numeric')
+        self.assertEqual(self.get_stored_amount(), D('99.99'))
+        self.assertFalse(
+            self.registry.System.Parameter.is_exist(CURRENCY_PARAMETER))
+
+        blok.pre_migration(parse_version('0.1.0'))
+        self.assertEqual(
+            blok.get_column_type('sale_order_line', 'amount_total'),
+            'bigint')
+        self.assertEqual(self.get_stored_amount(), 9999)
+
+    def test_check_currency(self):
+        blok = BlokManager.get('sale_minor_units')(self.registry)
+        self.assertEqual(
+            self.registry.System.Parameter.get(CURRENCY_PARAMETER), CURRENCY)
+        blok.load()
+
+        other = 'JPY' if CURRENCY != 'JPY' else 'EUR'
+        with patch('anyblok_sale.bloks.sale_minor_units.model.CURRENCY',
+                   other):
+            with self.assertRaises(CurrencyException):
+                blok.load()
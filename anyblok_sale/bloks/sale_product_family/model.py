@@ -0,0 +1,31 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+
+from anyblok import Declarations
+
+from anyblok_sale.bloks.sale_base.base import invalidate_cache_from_orm_event
+
+
+@Declarations.register(Declarations.Model.Product)
+class Family:
+    """Overrides Product.Family model in order to invalidate the properties
+    schemas cached by Sale.Order.Line
+    """
+
+    @classmethod
+    def after_update_orm_event(cls, mapper, connection, target):
+        invalidate_cache_from_orm_event(
+            connection, cls.registry.Sale.Order.Line,
+            'get_properties_schema')
+
+    @classmethod
+    def after_delete_orm_event(cls, mapper, connection, target):
+        invalidate_cache_from_orm_event(
+            connection, cls.registry.Sale.Order.Line,
+            'get_properties_schema')
@@ -0,0 +1,73 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+from unittest.mock import patch
+
+from anyblok.tests.testcase import BlokTestCase
+from marshmallow import Schema, fields
+
+from anyblok_sale.bloks.sale.model import LineException
+
+
+class SizeSchema(Schema):
+    size = fields.String()
+
+
+class TestFamilyModel(BlokTestCase):
+    """Test Product.Family overrides"""
+
+    def create_line(self, custom_schemas):
+        Product = self.registry.Product
+        patcher = patch.object(Product.Family, 'custom_schemas',
+                               custom_schemas, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        family = Product.Family.insert(code="TEST", name="Test")
+        template = Product.Template.insert(code="TEST", name="Test",
+                                           family=family)
+        item = Product.Item.insert(code="TEST", name="Test",
+                                   template=template)
+        so = self.registry.Sale.Order.create(channel="WEBSITE",
+                                             code="SO-TEST-000001")
+        line = self.registry.Sale.Order.Line.create(
+            order=so, item=item, quantity=1, unit_price=100, unit_tax=20,
+            properties={"size": "M"})
+        self.registry.flush()
+        return family, line
+
+    def test_line_flush_uses_properties_schema_cache(self):
+        Line = self.registry.Sale.Order.Line
+        self.assertTrue(Line.has_product_family())
+        family, line = self.create_line({'test': {'schema': SizeSchema}})
+        Line.get_properties_schema.cache_clear()
+
+        line.quantity = 2
+        self.registry.flush()
+        info = Line.get_properties_schema.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 1, 1))
+
+        line.quantity = 3
+        self.registry.flush()
+        info = Line.get_properties_schema.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+        family.name = "Other"
+        self.registry.flush()
+        self.assertEqual(Line.get_properties_schema.cache_info().currsize, 0)
+
+        line.quantity = 4
+        self.registry.flush()
+        info = Line.get_properties_schema.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 1, 1))
+
+    def test_line_flush_without_item_properties_schema(self):
+        family, line = self.create_line({'other': {'schema': SizeSchema}})
+        line.quantity = 2
+        with self.assertRaises(LineException):
+            self.registry.flush()
@@ -0,0 +1,21 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+import os
+
+from anyblok.config import Configuration
+
+
+@Configuration.add('database')
+def define_sale_currency(group):
+    group.add_argument('--sale-currency',
+                       default=os.environ.get('ANYBLOK_SALE_CURRENCY', 'EUR'),
+                       help="ISO 4217 code of the currency of the sale "
+                            "amounts, gives the scale of the amounts stored "
+                            "as minor units by sale_minor_units, must not "
+                            "change once the blok is installed")
@@ -0,0 +1,294 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+"""Deterministic dataset generator for load testing
+
+The rows are built in python from a seeded random generator and written
+with multi rows INSERT statements, one transaction per chunk. The ORM,
+the schema validation and the orm events are bypassed, the amounts are
+computed as ``Sale.Order.Line.compute`` and ``Sale.Order.compute`` would
+and ``Sale.Order.DailySummary`` is rebuilt at the end.
+"""
+from bisect import bisect
+from datetime import datetime, timedelta
+from decimal import Decimal as D
+from itertools import accumulate
+from logging import getLogger
+from random import Random
+from uuid import UUID
+
+from sqlalchemy import select
+
+from anyblok_sale.bloks.sale_base.base import compute_price, compute_tax
+from anyblok_sale.bloks.sale.model import compute_properties_hash
+
+logger = getLogger(__name__)
+
+TAX_RATES = (D('0.2'), D('0.1'), D('0.055'))
+ORDER_STATES = (('draft', 10), ('quotation', 20), ('order', 60),
+                ('cancelled', 10))
+LINE_COUNTS = ((1, 40), (2, 25), (3, 15), (5, 10), (10, 7), (50, 3))
+
+
+def parse_line_counts(values):
+    """Parse a line count distribution given as ``count:weight`` values
+
+    >>> parse_line_counts(['1:50', '5:40', '100:10'])
+    >>> ((1, 50), (5, 40), (100, 10))
+    """
+    distribution = []
+    for value in values:
+        count, weight = value.split(':')
+        distribution.append((int(count), int(weight)))
+
+    return tuple(distribution)
+
+
+def weighted_choice(random, distribution):
+    """Pick a value in a ((value, weight), ...) distribution"""
+    values, weights = zip(*distribution)
+    cumulated = list(accumulate(weights))
+    return values[bisect(cumulated, random.random() * cumulated[-1])]
+
+
+def get_foreign_key(table, remote_table):
+    """Return the name of the column of table referencing remote_table"""
+    for foreign_key in table.foreign_keys:
+        if foreign_key.column.table is remote_table:
+            return foreign_key.parent.name
+
+    return None
+
+
+class DatasetGenerator:
+    """Populate the database with customers, price lists and orders
+
+    :param registry: registry with the sale blok installed
+    :param seed: seed of the random generator, the same seed and options
+                 give the same dataset
+    :param chunk_size: number of orders inserted per transaction
+    :param date_from: creation date of the first orders
+    :param days: orders are created over this number of days
+    :param autocommit: commit each chunk, if False the rows are left in
+                       the current transaction
+    """
+
+    def __init__(self, registry, seed=0, chunk_size=1000,
+                 date_from=datetime(2018, 1, 1), days=365, autocommit=True):
+        self.registry = registry
+        self.random = Random(seed)
+        self.chunk_size = chunk_size
+        self.date_from = date_from
+        self.days = days
+        self.autocommit = autocommit
+
+    def commit(self):
+        if self.autocommit:
+            self.registry.commit()
+
+    def uuid(self):
+        return UUID(int=self.random.getrandbits(128), version=4)
+
+    def date(self):
+        return self.date_from + timedelta(
+            seconds=self.random.randrange(self.days * 86400))
+
+    def insert(self, model, rows):
+        for i in range(0, len(rows), self.chunk_size):
+            self.registry.execute(
+                model.__table__.insert().values(rows[i:i + self.chunk_size]))
+
+    def create_items(self, count, prefix):
+        """Insert product items and return their primary keys"""
+        Item = self.registry.Product.Item
+        table = Item.__table__
+        self.insert(Item, [dict(code="%s-%08d" % (prefix, i),
+                                name="Item %d" % i)
+                           for i in range(count)])
+
+        pks = Item.get_primary_keys()
+        query = select([table.c[pk] for pk in pks]).where(
+            table.c.code.like(prefix + '-%')).order_by(table.c.code)
+        return [dict(zip(pks, row))
+                for row in self.registry.execute(query)]
+
+    def create_price_lists(self, count, item_count, prefix='DATASET'):
+        """Insert price lists with item_count items each
+
+        :return: list of (price list uuid, [(item keys, price, tax)])
+        """
+        PriceList = self.registry.Sale.PriceList
+        Item = PriceList.Item
+        item_fk = get_foreign_key(Item.__table__,
+                                  self.registry.Product.Item.__table__)
+        items = self.create_items(count * item_count, prefix)
+        now = self.date_from
+
+        price_lists = []
+        price_list_rows = []
+        item_rows = []
+        for i in range(count):
+            uuid = self.uuid()
+            price_list_rows.append(dict(
+                uuid=uuid, code="%s-%04d" % (prefix, i),
+                name="Price list %d" % i, create_date=now, edit_date=now))
+            prices = []
+            for item_keys in items[i * item_count:(i + 1) * item_count]:
+                tax = self.random.choice(TAX_RATES)
+                price = compute_price(
+                    gross=D(self.random.randrange(100, 20000)) / 100,
+                    tax=tax, keep_gross=True)
+                prices.append((item_keys, price, tax))
+                item_rows.append({
+                    'uuid': self.uuid(), 'price_list_uuid': uuid,
+                    item_fk: list(item_keys.values())[0],
+                    'unit_price_untaxed': price.net.amount,
+                    'unit_price': price.gross.amount,
+                    'unit_tax': compute_tax(tax),
+                    'create_date': now, 'edit_date': now})
+
+            price_lists.append((uuid, prices))
+
+        self.insert(PriceList, price_list_rows)
+        self.insert(Item, item_rows)
+        self.commit()
+        logger.info("%d price lists with %d items created", count,
+                    len(item_rows))
+        return price_lists
+
+    def create_customers(self, count, price_lists):
+        """Insert customers, each one with a default price list when the
+        customer_sale blok is installed
+
+        :return: list of (customer uuid, price list)
+        """
+        Customer = self.registry.Sale.Customer
+        has_price_list = 'price_list_uuid' in Customer.__table__.c
+        now = self.date_from
+
+        customers = []
+        rows = []
+        for i in range(count):
+            uuid = self.uuid()
+            price_list = self.random.choice(price_lists)
+            row = dict(uuid=uuid, email="customer-%08d@example.com" % i,
+                       first_name="First %d" % i, last_name="Last %d" % i,
+                       create_date=now, edit_date=now)
+            if has_price_list:
+                row['price_list_uuid'] = price_list[0]
+
+            rows.append(row)
+            customers.append((uuid, price_list))
+
+        self.insert(Customer, rows)
+        self.commit()
+        logger.info("%d customers created", count)
+        return customers
+
+    def build_order(self, number, price_list, customer_uuid=None,
+                    line_counts=LINE_COUNTS):
+        """Build the row of an order and the rows of its lines"""
+        Order = self.registry.Sale.Order
+        item_fk = get_foreign_key(Order.Line.__table__,
+                                  self.registry.Product.Item.__table__)
+        price_list_uuid, prices = price_list
+        line_count = min(weighted_choice(self.random, line_counts),
+                         len(prices))
+        create_date = self.date()
+
+        uuid = self.uuid()
+        lines = []
+        breakdown = {}
+        for item_keys, price, tax in self.random.sample(prices, line_count):
+            quantity = self.random.randint(1, 5)
+            amount_total = price.gross.amount * quantity
+            amount_untaxed = price.net.amount * quantity
+            amount_tax = amount_total - amount_untaxed
+            rate = breakdown.setdefault(compute_tax(tax), [D(0), D(0), D(0)])
+            rate[0] += amount_untaxed
+            rate[1] += amount_tax
+            rate[2] += amount_total
+            lines.append({
+                'uuid': self.uuid(), 'order_uuid': uuid,
+                item_fk: list(item_keys.values())[0],
+                'properties': {},
+                'properties_hash': compute_properties_hash(item_keys, {}),
+                'unit_price_untaxed': price.net.amount,
+                'unit_price': price.gross.amount,
+                'unit_tax': compute_tax(tax), 'quantity': quantity,
+                'amount_untaxed': amount_untaxed, 'amount_tax': amount_tax,
+                'amount_total': amount_total,
+                'create_date': create_date, 'edit_date': create_date})
+
+        order = {
+            'uuid': uuid, 'code': "SO-DATASET-%08d" % number,
+            'channel': self.random.choice(('WEBSITE', 'SHOP', 'PHONE')),
+            'state': weighted_choice(self.random, ORDER_STATES),
+            'price_list_uuid': price_list_uuid,
+            'amount_untaxed': sum(x['amount_untaxed'] for x in lines),
+            'amount_tax': sum(x['amount_tax'] for x in lines),
+            'amount_total': sum(x['amount_total'] for x in lines),
+            'line_count': len(lines),
+            'total_quantity': sum(x['quantity'] for x in lines),
+            'tax_breakdown': {
+                str(rate): {'base': str(base), 'tax': str(tax),
+                            'total': str(total)}
+                for rate, (base, tax, total) in breakdown.items()},
+            'create_date': create_date, 'edit_date': create_date}
+        if customer_uuid is not None:
+            order['customer_uuid'] = customer_uuid
+
+        return order, lines
+
+    def create_orders(self, count, price_lists, customers=None,
+                      line_counts=LINE_COUNTS, first_number=0):
+        """Insert orders and their lines, one transaction per chunk of
+        ``chunk_size`` orders
+
+        Orders of a customer use its default price list
+
+        :param first_number: number of the first order in the order codes
+        """
+        Order = self.registry.Sale.Order
+        has_customer = 'customer_uuid' in Order.__table__.c
+        end = first_number + count
+        for start in range(first_number, end, self.chunk_size):
+            orders = []
+            lines = []
+            for number in range(start, min(start + self.chunk_size, end)):
+                customer_uuid = None
+                price_list = self.random.choice(price_lists)
+                if has_customer and customers:
+                    customer_uuid, price_list = self.random.choice(customers)
+
+                order, order_lines = self.build_order(
+                    number, price_list, customer_uuid=customer_uuid,
+                    line_counts=line_counts)
+                orders.append(order)
+                lines.extend(order_lines)
+
+            self.insert(Order, orders)
+            self.insert(Order.Line, lines)
+            self.commit()
+            logger.info("%d/%d orders created",
+                        start - first_number + len(orders), count)
+
+    def generate(self, customers=0, price_lists=1, items=100, orders=0,
+                 line_counts=LINE_COUNTS):
+        """Generate the whole dataset"""
+        all_price_lists = self.create_price_lists(price_lists, items)
+        all_customers = []
+        if customers and self.registry.System.Blok.is_installed('customer'):
+            all_customers = self.create_customers(customers, all_price_lists)
+
+        self.create_orders(orders, all_price_lists, customers=all_customers,
+                           line_counts=line_counts)
+        self.registry.Sale.Order.DailySummary.rebuild(
+            self.date_from.date(),
+            (self.date_from + timedelta(days=self.days)).date())
+        self.commit()
@@ -0,0 +1,180 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+"""Concurrent order intake load generator
+
+Worker processes create orders with lines and drive them through
+``draft -> quotation -> order``, one transaction per order, as an order
+intake would. The latencies of each step are measured in the workers and
+reported as percentiles by the parent process. The throughput is computed
+over the window from the first order started by a worker to the last order
+ended, the registry load of the workers is not counted.
+"""
+import multiprocessing
+from collections import Counter, OrderedDict
+from decimal import Decimal as D
+from math import ceil
+from random import Random
+from time import perf_counter, time
+
+from anyblok.registry import RegistryManager
+from sqlalchemy.exc import DBAPIError
+
+OPERATIONS = ('create', 'compute', 'transition')
+
+# PostgreSQL error codes reported by name
+PG_ERRORS = {
+    '40001': 'serialization_failure',
+    '40P01': 'deadlock_detected',
+    '55P03': 'lock_not_available',
+    '57014': 'query_canceled',
+}
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of a list of values"""
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = max(int(ceil(percent / 100 * len(values))), 1)
+    return values[rank - 1]
+
+
+def prepare_items(registry, count, prefix='LOAD'):
+    """Create the product items used by the workers if they do not exist
+
+    :return: codes of the items
+    """
+    Item = registry.Product.Item
+    codes = ["%s-%06d" % (prefix, i) for i in range(count)]
+    existing = {x.code for x in Item.query().filter(Item.code.in_(codes))}
+    for code in codes:
+        if code not in existing:
+            Item.insert(code=code, name=code)
+
+    registry.commit()
+    return codes
+
+
+def intake_order(registry, number, items, quantity, timings):
+    """Create one order, compute and confirm it, measuring each step"""
+    Order = registry.Sale.Order
+
+    start = perf_counter()
+    order = Order.create(channel="LOAD", code="SO-LOAD-%s" % number)
+    for item in items:
+        Order.Line.create(order=order, item=item, quantity=quantity,
+                          unit_price=D('12.34'), unit_tax=D('0.2'))
+
+    registry.flush()
+    timings['create'].append(perf_counter() - start)
+
+    start = perf_counter()
+    order.compute()
+    registry.flush()
+    timings['compute'].append(perf_counter() - start)
+
+    start = perf_counter()
+    order.state_to('quotation')
+    order.state_to('order')
+    timings['transition'].append(perf_counter() - start)
+
+    registry.commit()
+
+
+def get_error_name(exception):
+    """Return the name of the error of a failed order, the PostgreSQL
+    error (deadlock, lock timeout, ...) for the database errors else the
+    exception class (StaleDataError, ...)
+    """
+    if isinstance(exception, DBAPIError):
+        pgcode = getattr(exception.orig, 'pgcode', None)
+        if pgcode in PG_ERRORS:
+            return PG_ERRORS[pgcode]
+
+    return exception.__class__.__name__
+
+
+def worker(db_name, worker_id, orders, lines, codes, seed):
+    """Entry point of a worker process
+
+    :return: (timings per operation, number of failed orders per error,
+              (start, end) wall clock times of the orders)
+    """
+    registry = RegistryManager.get(db_name)
+    Item = registry.Product.Item
+    items = Item.query().filter(Item.code.in_(codes)).all()
+    random = Random(seed + worker_id)
+    timings = {operation: [] for operation in OPERATIONS}
+    errors = Counter()
+    start = time()
+    try:
+        for i in range(orders):
+            try:
+                intake_order(registry, "%d-%d" % (worker_id, i),
+                             random.sample(items, min(lines, len(items))),
+                             random.randint(1, 5), timings)
+            except Exception as e:
+                registry.rollback()
+                errors[get_error_name(e)] += 1
+    finally:
+        end = time()
+        registry.close()
+
+    return timings, errors, (start, end)
+
+
+def run_load(registry, workers=4, orders=100, lines=10, items=100, seed=0):
+    """Run the order intake with ``workers`` processes
+
+    :param registry: registry of the database to load, closed before the
+                     workers are started
+    :param workers: number of worker processes
+    :param orders: number of orders created by each worker
+    :param lines: number of lines per order
+    :param items: number of product items the lines are picked from
+    :param seed: seed of the random generators of the workers
+    :return: throughput, failed orders per error and latency percentiles
+             in seconds per operation
+    """
+    db_name = registry.db_name
+    codes = prepare_items(registry, items)
+    registry.close()
+    RegistryManager.clear()
+
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers) as pool:
+        results = pool.starmap(
+            worker, [(db_name, worker_id, orders, lines, codes, seed)
+                     for worker_id in range(workers)])
+
+    timings = {operation: [] for operation in OPERATIONS}
+    errors = Counter()
+    for worker_timings, worker_errors, _ in results:
+        errors.update(worker_errors)
+        for operation, values in worker_timings.items():
+            timings[operation].extend(values)
+
+    duration = (max(end for _, _, (_, end) in results) -
+                min(start for _, _, (start, _) in results))
+    created = len(timings['transition'])
+    report = OrderedDict((
+        ('workers', workers),
+        ('orders', created),
+        ('errors', sum(errors.values())),
+        ('error_types', OrderedDict(sorted(errors.items()))),
+        ('duration', duration),
+        ('throughput', created / duration if duration else None),
+    ))
+    for operation in OPERATIONS:
+        report[operation] = OrderedDict(
+            ('p%d' % percent, percentile(timings[operation], percent))
+            for percent in (50, 95, 99))
+
+    return report
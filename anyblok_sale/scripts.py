@@ -0,0 +1,226 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+import json
+from datetime import date, datetime, timedelta
+from time import sleep
+
+import anyblok
+from anyblok.config import Configuration
+from anyblok.release import version
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+@Configuration.add('sale-summary', label="Sale daily summary")
+def add_sale_summary(parser):
+    parser.add_argument('--summary-date-from', type=parse_date,
+                        help="First day to rebuild (YYYY-MM-DD), only the "
+                             "pending deltas are rolled up if not given")
+    parser.add_argument('--summary-date-to', type=parse_date,
+                        help="Last day to rebuild (YYYY-MM-DD), default "
+                             "today")
+
+
+Configuration.add_application_properties(
+    'sale_rebuild_summary', ['logging', 'sale-summary'],
+    prog='AnyBlok Sale rebuild daily summary, version %r' % version,
+    description="Roll up the pending deltas of Sale.Order.DailySummary and "
+                "rebuild it for a date range"
+)
+
+
+def anyblok_sale_rebuild_summary():
+    """Roll up the daily sales summary deltas, to run periodically, and
+    rebuild the summary for a date range if given
+    """
+    registry = anyblok.start('sale_rebuild_summary')
+    if registry:
+        DailySummary = registry.Sale.Order.DailySummary
+        DailySummary.rollup()
+        registry.commit()
+        date_from = Configuration.get('summary_date_from')
+        if date_from is not None:
+            date_to = Configuration.get('summary_date_to') or date.today()
+            DailySummary.rebuild(date_from, date_to)
+            registry.commit()
+
+        registry.close()
+
+
+@Configuration.add('sale-benchmark', label="Sale benchmarks")
+def add_sale_benchmark(parser):
+    parser.add_argument('--benchmark-output', default='benchmark.json',
+                        help="JSON file where the results are written")
+    parser.add_argument('--benchmark-names', nargs='+',
+                        help="Benchmarks to run, all by default")
+    parser.add_argument('--benchmark-search-orders', type=int,
+                        help="Number of orders searched by the order_search "
+                             "benchmark, the missing dataset orders are "
+                             "generated. Without it only an existing "
+                             "dataset is searched")
+
+
+Configuration.add_application_properties(
+    'sale_benchmark', ['logging', 'sale-benchmark'],
+    prog='AnyBlok Sale benchmarks, version %r' % version,
+    description="Run the sale benchmarks and write the results as JSON"
+)
+
+
+def anyblok_sale_benchmark():
+    """Run the sale benchmarks against the configured database, nothing is
+    committed
+    """
+    from anyblok_sale.benchmark import run_benchmarks, dump_results
+
+    registry = anyblok.start('sale_benchmark')
+    if registry:
+        results = run_benchmarks(
+            registry, names=Configuration.get('benchmark_names'))
+        dump_results(results, Configuration.get('benchmark_output'))
+        registry.rollback()
+        registry.close()
+
+
+@Configuration.add('sale-dataset', label="Sale dataset")
+def add_sale_dataset(parser):
+    parser.add_argument('--dataset-seed', type=int, default=0,
+                        help="Seed of the random generator")
+    parser.add_argument('--dataset-customers', type=int, default=1000,
+                        help="Number of customers")
+    parser.add_argument('--dataset-price-lists', type=int, default=10,
+                        help="Number of price lists")
+    parser.add_argument('--dataset-items', type=int, default=100,
+                        help="Number of items per price list")
+    parser.add_argument('--dataset-orders', type=int, default=10000,
+                        help="Number of orders")
+    parser.add_argument('--dataset-line-counts', nargs='+',
+                        help="Distribution of the number of lines per order "
+                             "as count:weight values, e.g. 1:50 5:40 100:10")
+    parser.add_argument('--dataset-chunk-size', type=int, default=1000,
+                        help="Number of orders inserted per transaction")
+
+
+Configuration.add_application_properties(
+    'sale_generate_dataset', ['logging', 'sale-dataset'],
+    prog='AnyBlok Sale dataset generator, version %r' % version,
+    description="Populate the database with a deterministic sale dataset"
+)
+
+
+def anyblok_sale_generate_dataset():
+    """Populate the database with customers, price lists and orders"""
+    from anyblok_sale.dataset import (
+        DatasetGenerator, LINE_COUNTS, parse_line_counts)
+
+    registry = anyblok.start('sale_generate_dataset')
+    if registry:
+        line_counts = Configuration.get('dataset_line_counts')
+        generator = DatasetGenerator(
+            registry, seed=Configuration.get('dataset_seed'),
+            chunk_size=Configuration.get('dataset_chunk_size'))
+        generator.generate(
+            customers=Configuration.get('dataset_customers'),
+            price_lists=Configuration.get('dataset_price_lists'),
+            items=Configuration.get('dataset_items'),
+            orders=Configuration.get('dataset_orders'),
+            line_counts=(parse_line_counts(line_counts)
+                         if line_counts else LINE_COUNTS))
+        registry.close()
+
+
+@Configuration.add('sale-load', label="Sale order intake load")
+def add_sale_load(parser):
+    parser.add_argument('--load-workers', type=int, default=4,
+                        help="Number of worker processes")
+    parser.add_argument('--load-orders', type=int, default=100,
+                        help="Number of orders created by each worker")
+    parser.add_argument('--load-lines', type=int, default=10,
+                        help="Number of lines per order")
+    parser.add_argument('--load-items', type=int, default=100,
+                        help="Number of product items used by the lines")
+    parser.add_argument('--load-seed', type=int, default=0,
+                        help="Seed of the random generators")
+    parser.add_argument('--load-output',
+                        help="JSON file where the report is written")
+
+
+Configuration.add_application_properties(
+    'sale_load', ['logging', 'sale-load'],
+    prog='AnyBlok Sale order intake load, version %r' % version,
+    description="Create and confirm orders from concurrent workers and "
+                "report the throughput and latency percentiles"
+)
+
+
+def anyblok_sale_load():
+    """Run the concurrent order intake load against the configured
+    database, the orders are committed
+    """
+    from anyblok_sale.load import run_load
+
+    registry = anyblok.start('sale_load')
+    if registry:
+        report = run_load(
+            registry, workers=Configuration.get('load_workers'),
+            orders=Configuration.get('load_orders'),
+            lines=Configuration.get('load_lines'),
+            items=Configuration.get('load_items'),
+            seed=Configuration.get('load_seed'))
+        print(json.dumps(report, indent=2))
+        output = Configuration.get('load_output')
+        if output:
+            with open(output, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+
+
+@Configuration.add('sale-expiry', label="Sale quotations expiry")
+def add_sale_expiry(parser):
+    parser.add_argument('--expiry-max-age', type=float, default=30,
+                        help="Age in days after which draft and quotation "
+                             "orders are cancelled")
+    parser.add_argument('--expiry-batch-size', type=int, default=500,
+                        help="Number of orders cancelled per transaction")
+    parser.add_argument('--expiry-interval', type=float, default=0,
+                        help="Seconds between two sweeps, 0 to sweep once")
+
+
+Configuration.add_application_properties(
+    'sale_expire_quotations', ['logging', 'sale-expiry'],
+    prog='AnyBlok Sale quotations expiry, version %r' % version,
+    description="Cancel the draft and quotation orders older than a "
+                "maximum age, in chunks"
+)
+
+
+def anyblok_sale_expire_quotations():
+    """Cancel the expired draft and quotation orders, one transaction per
+    chunk, once or continuously
+    """
+    registry = anyblok.start('sale_expire_quotations')
+    if registry:
+        max_age = timedelta(days=Configuration.get('expiry_max_age'))
+        batch_size = Configuration.get('expiry_batch_size')
+        interval = Configuration.get('expiry_interval')
+        while True:
+            while True:
+                count = registry.Sale.Order.expire_quotations(
+                    max_age, batch_size=batch_size)
+                registry.commit()
+                if count < batch_size:
+                    break
+
+            if not interval:
+                break
+
+            sleep(interval)
+
+        registry.close()
@@ -0,0 +1,116 @@
+# This file is a part of the AnyBlok / Sale project
+#
+#    Copyright (C) 2018 Franck Bret <franckbret@gmail.com>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+# -*- coding: utf-8 -*-
+"""Test helpers counting the SQL statements emitted by sale operations"""
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """Record the SQL statements executed on the registry connection
+
+    ::
+
+        with QueryCounter(registry) as counter:
+            order.compute()
+            registry.flush()
+
+        counter.count
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.statements = []
+        self.connection = None
+
+    def callback(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self.connection = self.registry.connection()
+        event.listen(self.connection, 'before_cursor_execute', self.callback)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.connection, 'before_cursor_execute', self.callback)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class QueryCountTestCase:
+    """Mixin of BlokTestCase asserting query budgets
+
+    ::
+
+        class TestOrder(QueryCountTestCase, BlokTestCase):
+
+            def test_compute(self):
+                with self.assertQueryBudget(3):
+                    order.compute()
+    """
+
+    def format_statements(self, counter):
+        return '\n'.join('%d. %s' % (i, statement)
+                         for i, statement in enumerate(counter.statements, 1))
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        """Fail if the block executes more than ``budget`` statements"""
+        with QueryCounter(self.registry) as counter:
+            yield counter
+
+        if counter.count > budget:
+            self.fail("%d statements executed, budget is %d:\n%s" % (
+                counter.count, budget, self.format_statements(counter)))
+
+    def assertQueryCountScale(self, prepare, run, sizes=(1, 10), budget=None,
+                              per_item=0):
+        """Fail if the number of statements executed by ``run`` grows with
+        the size of the data more than ``per_item`` statements per item
+
+        :param prepare: callable taking a size and returning the argument
+                        given to run, not counted
+        :param run: callable counted
+        :param sizes: sizes of data compared
+        :param budget: budget for the smallest size
+        :param per_item: statements allowed per additional item
+        :return: statements count per size
+        """
+        counts = {}
+        for size in sizes:
+            data = prepare(size)
+            self.registry.flush()
+            self.registry.expire_all()
+            with QueryCounter(self.registry) as counter:
+                run(data)
+                self.registry.flush()
+
+            counts[size] = counter
+            if budget is not None and size == min(sizes):
+                if counter.count > budget:
+                    self.fail(
+                        "%d statements executed for %d items, budget is "
+                        "%d:\n%s" % (counter.count, size, budget,
+                                     self.format_statements(counter)))
+
+        smallest = min(sizes)
+        for size in sizes:
+            allowed = counts[smallest].count + per_item * (size - smallest)
+            if counts[size].count > allowed:
+                self.fail(
+                    "%d statements executed for %d items, %d for %d items "
+                    "(%d statements allowed per item):\n%s" % (
+                        counts[size].count, size, counts[smallest].count,
+                        smallest, per_item,
+                        self.format_statements(counts[size])))
+
+        return {size: counter.count for size, counter in counts.items()}
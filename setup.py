@@ -37,6 +37,10 @@ requirements = [
     'prices',
 ]
 
+extra_requirements = {
+    'analytics': ['pyarrow'],
+}
+
 test_requirements = [
     # TODO: put package test requirements here
 ]
@@ -51,16 +55,35 @@ setup(
     url='https://github.com/AnyBlok/anyblok_sale',
     packages=find_packages(),
     entry_points={
+        'console_scripts': [
+            ('anyblok_sale_rebuild_summary='
+             'anyblok_sale.scripts:anyblok_sale_rebuild_summary'),
+            ('anyblok_sale_benchmark='
+             'anyblok_sale.scripts:anyblok_sale_benchmark'),
+            ('anyblok_sale_generate_dataset='
+             'anyblok_sale.scripts:anyblok_sale_generate_dataset'),
+            'anyblok_sale_load=anyblok_sale.scripts:anyblok_sale_load',
+            ('anyblok_sale_expire_quotations='
+             'anyblok_sale.scripts:anyblok_sale_expire_quotations'),
+        ],
+        'anyblok.init': [
+            'anyblok_sale_config=anyblok_sale:anyblok_init_config',
+        ],
         'bloks': [
             'sale_base=anyblok_sale.bloks.sale_base:SaleBaseBlok',
             'sale=anyblok_sale.bloks.sale:SaleBlok',
             'customer=anyblok_sale.bloks.customer:CustomerBlok',
             'customer_sale=anyblok_sale.bloks.customer_sale:CustomerSaleBlok',
             'pricelist=anyblok_sale.bloks.price_list:PriceListBlok',
+            ('sale_product_family=anyblok_sale.bloks.sale_product_family:'
+             'SaleProductFamilyBlok'),
+            ('sale_minor_units=anyblok_sale.bloks.sale_minor_units:'
+             'SaleMinorUnitsBlok'),
         ],
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extra_requirements,
     zip_safe=False,
     keywords='anyblok_sale, anyblok, sale',
     classifiers=[